@@ -0,0 +1,287 @@
+# === bench/bench_load.py — load test of dp against a fake Bot API + fake photo providers ===
+# اجرا:
+#   DATABASE_URL=postgresql://... python bench/bench_load.py
+# تنظیمات (env):
+#   BENCH_USERS=50          تعداد کاربر هم‌زمان
+#   BENCH_ACTIONS=20        تعداد کار هر کاربر (دکمهٔ عکس، جستجو، «مجدد»...)
+#   BENCH_TG_LATENCY_MS=30  تأخیر هر متد Bot API جعلی
+#   BENCH_PROVIDER_LATENCY_MS=150  تأخیر Unsplash/Pexels/Pixabay جعلی (±50٪)
+#   BENCH_IMAGE_LATENCY_MS=50      تأخیر HEAD/GET روی URL عکس‌ها (±50٪)
+#   BENCH_PHOTOS=2000       تعداد عکس خزانه (posted_photos)
+#   BENCH_BAD_URL_RATE=0.05 سهم URLهای provider که 404 یا بزرگ‌تر از ۵MB هستند
+# همه‌چیز داخل schema جدای bench_load ساخته و در پایان حذف می‌شود؛ به جداول اصلی دست نمی‌زند.
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import asyncio
+import statistics
+from collections import defaultdict
+from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
+
+import asyncpg
+from aiohttp import web
+
+SCHEMA = "bench_load"
+USERS = int(os.getenv("BENCH_USERS", "50"))
+ACTIONS = int(os.getenv("BENCH_ACTIONS", "20"))
+TG_LATENCY = int(os.getenv("BENCH_TG_LATENCY_MS", "30")) / 1000
+PROVIDER_LATENCY = int(os.getenv("BENCH_PROVIDER_LATENCY_MS", "150")) / 1000
+IMAGE_LATENCY = int(os.getenv("BENCH_IMAGE_LATENCY_MS", "50")) / 1000
+PHOTOS = int(os.getenv("BENCH_PHOTOS", "2000"))
+BAD_URL_RATE = float(os.getenv("BENCH_BAD_URL_RATE", "0.05"))  # سهم URLهای مرده/بزرگ
+QUERIES = ["cat", "dog", "sunset", "mountain", "city", "ocean", "forest", "car", "flower", "space",
+           "coffee", "rain", "snow", "desert", "bridge", "night", "beach", "horse", "bird", "tree"]
+# (وزن، نوع کار)
+ACTION_MIX = [(3, "random_button"), (2, "random_retry"), (3, "search"), (2, "search_retry")]
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _with_search_path(dsn: str) -> str:
+    # پارامترهای ناشناختهٔ DSN را asyncpg به‌عنوان server_settings می‌فرستد
+    u = urlparse(dsn)
+    q = dict(parse_qsl(u.query))
+    q["search_path"] = SCHEMA
+    return urlunparse(u._replace(query=urlencode(q)))
+
+DSN = os.getenv("DATABASE_URL")
+if not DSN:
+    sys.exit("DATABASE_URL لازم است.")
+PORT = _free_port()
+BASE = f"http://127.0.0.1:{PORT}"
+IMG_BASE = f"http://127.0.0.2:{PORT}"
+
+# قبل از import main: همهٔ آدرس‌های بیرونی به سرور جعلی محلی
+os.environ.update({
+    "BOT_TOKEN": "123456:bench",
+    "DATABASE_URL": _with_search_path(DSN),
+    "TELEGRAM_API_URL": BASE,
+    "UNSPLASH_API_URL": f"{BASE}/unsplash/search/photos",
+    "PEXELS_API_URL": f"{BASE}/pexels/v1/search",
+    "PIXABAY_API_URL": f"{BASE}/pixabay/api/",
+    "UNSPLASH_ACCESS_KEY": "bench", "PEXELS_API_KEY": "bench", "PIXABAY_API_KEY": "bench",
+    "CHANNEL_1": "@bench_ch1", "CHANNEL_2": "@bench_ch2", "CHANNEL_4": "-1000000000004",
+    "ADMIN_ID": "0",
+})
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import main  # noqa: E402
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+
+# ---------- Fake Bot API + providers ----------
+TG_CALLS = defaultdict(int)
+MEDIA_ITEMS = defaultdict(int)  # "url" | "file_id" -> تعداد عکس ارسالی در آلبوم‌ها
+_msg_id = 0
+
+def _next_id() -> int:
+    global _msg_id
+    _msg_id += 1
+    return _msg_id
+
+def _message(chat_id, **extra):
+    return {"message_id": _next_id(), "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+def _photo(seed):
+    return [{"file_id": f"F{seed}", "file_unique_id": f"U{seed}", "width": 1280, "height": 853}]
+
+async def fake_bot_api(request):
+    method = request.match_info["method"]
+    TG_CALLS[method] += 1
+    data = dict(await request.post())
+    await asyncio.sleep(TG_LATENCY)
+    chat_id = data.get("chat_id", 0)
+    if method == "getChatMember":
+        result = {"user": {"id": int(data["user_id"]), "is_bot": False, "first_name": "u"}, "status": "member"}
+    elif method == "getMe":
+        result = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+    elif method in ("sendMessage", "editMessageText"):
+        result = _message(chat_id, text=data.get("text", ""))
+    elif method == "sendPhoto":
+        result = _message(chat_id, photo=_photo(_msg_id))
+    elif method == "sendMediaGroup":
+        media = json.loads(data.get("media", "[]"))
+        for item in media:
+            MEDIA_ITEMS["url" if item["media"].startswith("http") else "file_id"] += 1
+        result = [_message(chat_id, photo=_photo(_msg_id), media_group_id="g") for _ in media]
+    elif method == "copyMessage":
+        result = {"message_id": _next_id()}
+    else:
+        result = True
+    return web.json_response({"ok": True, "result": result})
+
+def _provider_urls(name, request):
+    q, page = request.query.get("query") or request.query.get("q"), request.query.get("page", "1")
+    # عکس‌ها روی host جدا (مثل CDN واقعی) تا سقف اتصال per-host با API مشترک نشود
+    return [f"{IMG_BASE}/img/{name}/{q}/{page}/{i}.jpg" for i in range(12)]
+
+async def _provider_sleep():
+    await asyncio.sleep(PROVIDER_LATENCY * random.uniform(0.5, 1.5))
+
+async def fake_unsplash(request):
+    await _provider_sleep()
+    return web.json_response({"results": [{"urls": {"regular": u}} for u in _provider_urls("unsplash", request)]})
+
+async def fake_pexels(request):
+    await _provider_sleep()
+    return web.json_response({"photos": [{"src": {"large": u}} for u in _provider_urls("pexels", request)]})
+
+async def fake_pixabay(request):
+    await _provider_sleep()
+    return web.json_response({"hits": [{"webformatURL": u} for u in _provider_urls("pixabay", request)]})
+
+IMAGE_CHECKS = defaultdict(int)
+
+async def fake_image(request):
+    # HEAD/GET یک‌بایتی برای اعتبارسنجی؛ URL بد به‌صورت قطعی از روی مسیر انتخاب می‌شود
+    IMAGE_CHECKS[request.method] += 1
+    await asyncio.sleep(IMAGE_LATENCY * random.uniform(0.5, 1.5))
+    # crc32 (نه hash()) تا مجموعهٔ URLهای بد مستقل از PYTHONHASHSEED و بین اجراها ثابت باشد
+    roll = (zlib.crc32(request.path.encode()) % 1000) / 1000
+    if roll < BAD_URL_RATE / 2:
+        return web.Response(status=404)
+    size = 9 * 1024 * 1024 if roll < BAD_URL_RATE else 250_000
+    headers = {"Content-Type": "image/jpeg"}
+    if request.headers.get("Range"):
+        headers["Content-Range"] = f"bytes 0-0/{size}"
+        return web.Response(status=206, body=b"\xff", headers=headers)
+    headers["Content-Length"] = str(size)
+    return web.Response(status=200, headers=headers)
+
+async def start_fake_server():
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", fake_bot_api)
+    app.router.add_get("/unsplash/search/photos", fake_unsplash)
+    app.router.add_get("/pexels/v1/search", fake_pexels)
+    app.router.add_get("/pixabay/api/", fake_pixabay)
+    app.router.add_get("/img/{tail:.*}", fake_image)  # HEAD هم همین‌جا
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    await web.TCPSite(runner, "127.0.0.2", PORT).start()
+    return runner
+
+# ---------- Load generator ----------
+_update_id = 0
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+def text_update(uid, text):
+    global _update_id
+    _update_id += 1
+    msg = _message(uid, text=text, **{"from": _user(uid)})
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return types.Update(**{"update_id": _update_id, "message": msg})
+
+def callback_update(uid, data):
+    global _update_id
+    _update_id += 1
+    return types.Update(**{"update_id": _update_id, "callback_query": {
+        "id": str(_update_id), "from": _user(uid), "chat_instance": "bench", "data": data,
+        "message": _message(uid, text="…", **{"from": {"id": 123456, "is_bot": True, "first_name": "bench"}}),
+    }})
+
+LATENCIES = defaultdict(list)  # kind -> [ms]
+
+async def timed_update(kind, update):
+    t0 = time.perf_counter()
+    await main.dp.process_update(update)
+    LATENCIES[kind].append((time.perf_counter() - t0) * 1000)
+
+async def simulate_user(uid, buttons):
+    random_btn, search_btn = buttons
+    await timed_update("start", text_update(uid, "/start"))
+    kinds = [k for w, k in ACTION_MIX for _ in range(w)]
+    for _ in range(ACTIONS):
+        kind = random.choice(kinds)
+        if kind == "random_button":
+            await timed_update(kind, text_update(uid, random_btn))
+        elif kind == "random_retry":
+            await timed_update(kind, callback_update(uid, "random"))
+        elif kind == "search":
+            await timed_update("search_button", text_update(uid, search_btn))
+            await timed_update("search_query", text_update(uid, random.choice(QUERIES)))
+        else:
+            await timed_update(kind, callback_update(uid, "search"))
+
+# ---------- Report ----------
+def summarize(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"n {len(samples):6d}   p50 {statistics.median(samples):8.2f} ms   p99 {p99:8.2f} ms"
+
+def _hist_counts(hist):
+    return {lv: v[-1] for lv, v in hist.values.items()}
+
+async def db_xacts(conn) -> int:
+    return await conn.fetchval(
+        "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()"
+    )
+
+async def main_async():
+    admin = await asyncpg.connect(DSN)
+    await admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+    runner = await start_fake_server()
+    try:
+        Bot.set_current(main.bot)
+        Dispatcher.set_current(main.dp)
+        await main.on_startup(main.dp)
+        if not main.DB_READY:
+            sys.exit(f"DB init failed: {main.LAST_DB_ERROR}")
+        await main.PG_POOL.execute(
+            "INSERT INTO posted_photos(message_id, file_id) SELECT g, 'F' || g FROM generate_series(1, $1) g "
+            "ON CONFLICT DO NOTHING",
+            PHOTOS,
+        )
+        buttons = tuple(b.text for row in main.main_kb.keyboard for b in row)[:2]
+
+        # از اینجا به بعد شمرده می‌شود
+        for m in main.METRICS:
+            m.values.clear()
+        TG_CALLS.clear()
+        MEDIA_ITEMS.clear()
+        IMAGE_CHECKS.clear()
+        xacts0 = await db_xacts(admin)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(simulate_user(1_000_000 + i, buttons) for i in range(USERS)))
+        elapsed = time.perf_counter() - t0
+        await main.on_shutdown(main.dp)  # write-behind بافرها flush می‌شوند
+        await main.PG_POOL.close()       # backendها با بسته شدن آمارشان را flush می‌کنند
+        await asyncio.sleep(0.5)
+        xacts = await db_xacts(admin) - xacts0 - 1
+
+        total = sum(len(v) for v in LATENCIES.values())
+        print(f"\n== {USERS} users x {ACTIONS} actions   tg {TG_LATENCY * 1000:.0f} ms   "
+              f"providers {PROVIDER_LATENCY * 1000:.0f} ms   {PHOTOS:,} photos")
+        print(f"  {total} updates in {elapsed:.2f}s  ->  {total / elapsed:.1f} updates/s\n")
+        for kind in sorted(LATENCIES):
+            print(f"  {kind:14s} {summarize(LATENCIES[kind])}")
+        print(f"  {'all':14s} {summarize([x for v in LATENCIES.values() for x in v])}")
+
+        db_calls = _hist_counts(main.DB_SECONDS)
+        print(f"\n  DB transactions (pg_stat_database): {xacts}  ({xacts / total:.2f} per update)")
+        print("  db_* helper calls: " + (", ".join(f"{op[0]}={n}" for op, n in sorted(db_calls.items())) or "0"))
+        print("  Bot API calls: " + ", ".join(f"{m}={n}" for m, n in sorted(TG_CALLS.items())))
+        print("  media group items: " + ", ".join(f"{k}={n}" for k, n in sorted(MEDIA_ITEMS.items())))
+        print("  image checks: " + (", ".join(f"{k}={n}" for k, n in sorted(IMAGE_CHECKS.items())) or "0"))
+        print("  provider calls: " + (", ".join(
+            f"{p}/{o}={n}" for (p, o), n in sorted(_hist_counts(main.PROVIDER_SECONDS).items())) or "0"))
+        errors = dict(main.HANDLER_ERRORS.values)
+        if errors:
+            print("  handler errors: " + ", ".join(f"{h[0]}={int(n)}" for h, n in errors.items()))
+    finally:
+        await runner.cleanup()
+        await admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await admin.close()
+        session = await main.bot.get_session()
+        await session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main_async())
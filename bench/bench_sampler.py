@@ -0,0 +1,100 @@
+# === bench/bench_sampler.py — pick_unseen_for_user: ORDER BY random() vs rnd index ===
+# اجرا:
+#   DATABASE_URL=postgresql://... python bench/bench_sampler.py
+# همه‌چیز داخل schema جدای bench_sampler ساخته و در پایان حذف می‌شود؛ به جداول اصلی دست نمی‌زند.
+import os
+import sys
+import time
+import random
+import asyncio
+import statistics
+
+import asyncpg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("CHANNEL_4", "-1000000000000")
+import main  # noqa: E402  (برای استفادهٔ مستقیم از PICK_UNSEEN_SQL)
+
+SCHEMA = "bench_sampler"
+PHOTO_SIZES = [10_000, 100_000]
+USED_ROWS = 1_000_000
+USERS = 1_000
+RUNS = 200
+
+LEGACY_SQL = """
+SELECT p.message_id
+FROM posted_photos p
+LEFT JOIN used_photos u ON u.message_id=p.message_id AND u.user_id=$1
+WHERE u.message_id IS NULL
+ORDER BY random()
+LIMIT $2
+"""
+
+async def setup(conn, photos: int):
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+    await conn.execute("""
+        CREATE TABLE posted_photos (
+          message_id BIGINT PRIMARY KEY,
+          added_at   TIMESTAMPTZ DEFAULT now(),
+          rnd        DOUBLE PRECISION NOT NULL DEFAULT random(),
+          file_id    TEXT,
+          caption    TEXT,
+          caption_entities JSONB
+        );
+        CREATE TABLE used_photos (
+          user_id    BIGINT,
+          message_id BIGINT,
+          used_at    TIMESTAMPTZ DEFAULT now(),
+          PRIMARY KEY (user_id, message_id)
+        );
+    """)
+    await conn.execute("INSERT INTO posted_photos(message_id, file_id) SELECT g, 'F' || g FROM generate_series(1, $1) g",
+                       photos)
+    await conn.execute("CREATE INDEX ON posted_photos(rnd)")
+    # ~1M ردیف: USERS کاربر، هر کدام ~USED_ROWS/USERS عکس دیده‌شده
+    await conn.execute(
+        """INSERT INTO used_photos(user_id, message_id)
+           SELECT (g % $2) + 1, floor(random() * $3)::bigint + 1
+           FROM generate_series(0, $1 - 1) g
+           ON CONFLICT DO NOTHING""",
+        USED_ROWS, USERS, photos
+    )
+    await conn.execute("ANALYZE posted_photos; ANALYZE used_photos;")
+
+def summarize(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50 {statistics.median(samples):7.2f} ms   p99 {p99:7.2f} ms"
+
+async def measure(conn, sql, args_fn):
+    stmt = await conn.prepare(sql)
+    samples = []
+    for _ in range(RUNS):
+        t0 = time.perf_counter()
+        await stmt.fetch(*args_fn())
+        samples.append((time.perf_counter() - t0) * 1000)
+    return summarize(samples)
+
+async def main_async():
+    dsn = os.getenv("DATABASE_URL")
+    if not dsn:
+        sys.exit("DATABASE_URL لازم است.")
+    conn = await asyncpg.connect(dsn, server_settings={"search_path": SCHEMA})
+    try:
+        for photos in PHOTO_SIZES:
+            t0 = time.perf_counter()
+            await setup(conn, photos)
+            used = await conn.fetchval("SELECT COUNT(*) FROM used_photos")
+            print(f"\n== {photos:,} photos / {used:,} used_photos rows (setup {time.perf_counter() - t0:.1f}s)")
+            user = lambda: random.randint(1, USERS)
+            legacy = await measure(conn, LEGACY_SQL, lambda: (user(), 3))
+            print(f"  ORDER BY random() : {legacy}")
+            sampler = await measure(conn, main.PICK_UNSEEN_SQL, lambda: (user(), random.random(), 3))
+            print(f"  rnd index sampler : {sampler}")
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.close()
+
+if __name__ == "__main__":
+    asyncio.run(main_async())
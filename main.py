@@ -1,14 +1,22 @@
 # === main.py — Final with robust Postgres handling ===
 import os
+import json
 import random
 import time
+import asyncio
 import aiohttp
+from aiohttp import web
 import asyncpg
 import logging
 import ssl
-from urllib.parse import urlparse
-
-from collections import defaultdict
+import signal
+import socket
+import contextlib
+import functools
+import datetime
+from urllib.parse import urlparse, urlunparse, urlencode, parse_qsl
+
+from collections import defaultdict, OrderedDict, deque
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
@@ -16,6 +24,12 @@ from aiogram.types import (
     InputMediaPhoto, BotCommand
 )
 from aiogram.utils import executor
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.utils.exceptions import (
+    BadRequest, RetryAfter, BotBlocked, BotKicked, ChatNotFound,
+    UserDeactivated, CantInitiateConversation,
+    MessageNotModified, MessageCantBeEdited, MessageToEditNotFound, MessageIdInvalid
+)
 from aiogram.dispatcher.filters import CommandStart
 
 # ---------- Logging ----------
@@ -29,6 +43,12 @@ UNSPLASH_ACCESS_KEY = os.getenv("UNSPLASH_ACCESS_KEY")
 PEXELS_API_KEY      = os.getenv("PEXELS_API_KEY")
 PIXABAY_API_KEY     = os.getenv("PIXABAY_API_KEY")
 
+# آدرس‌ها قابل override هستند (برای bench/ و Bot API server محلی)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # مثلاً http://127.0.0.1:8081
+UNSPLASH_API_URL = os.getenv("UNSPLASH_API_URL", "https://api.unsplash.com/search/photos")
+PEXELS_API_URL   = os.getenv("PEXELS_API_URL", "https://api.pexels.com/v1/search")
+PIXABAY_API_URL  = os.getenv("PIXABAY_API_URL", "https://pixabay.com/api/")
+
 CHANNEL_1 = os.getenv("CHANNEL_1")
 CHANNEL_2 = os.getenv("CHANNEL_2")
 CHANNEL_3 = os.getenv("CHANNEL_3")
@@ -40,8 +60,161 @@ CHANNEL_3_LINK = os.getenv("CHANNEL_3_LINK")
 
 INITIAL_ADMIN = int(os.getenv("ADMIN_ID", "0"))  # numeric user_id
 
+# ---------- Metrics ----------
+# خروجی با فرمت متنی Prometheus روی http://METRICS_HOST:METRICS_PORT/metrics (0 = خاموش)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# چند پروسه روی یک host (CLUSTER_MODE=multi): هر کدام اولین پورت آزاد از
+# METRICS_PORT تا METRICS_PORT+METRICS_PORT_SPAN-1 را می‌گیرد
+METRICS_PORT_SPAN = max(1, int(os.getenv("METRICS_PORT_SPAN", "16")))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = []        # همهٔ Counter/Histogramها به ترتیب ثبت
+METRIC_GAUGES = []  # (name, help, fn -> [(labels, value)]) که موقع scrape محاسبه می‌شوند
+
+def _fmt_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, help_, labels=()):
+        self.name, self.help, self.labels = name, help_, tuple(labels)
+        self.values = defaultdict(float)
+        METRICS.append(self)
+
+    def inc(self, *label_values, n=1):
+        self.values[label_values] += n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for lv, v in self.values.items():
+            yield f"{self.name}{_fmt_labels(self.labels, lv)} {v}"
+
+class Histogram:
+    def __init__(self, name, help_, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_, tuple(labels), buckets
+        self.values = {}  # label_values -> [bucket counts..., sum, count]
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        v = self.values.get(label_values)
+        if v is None:
+            v = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                v[i] += 1
+        v[-2] += value
+        v[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for lv, v in self.values.items():
+            for i, b in enumerate(self.buckets):
+                yield f"{self.name}_bucket{_fmt_labels(names, lv + (b,))} {v[i]}"
+            yield f"{self.name}_bucket{_fmt_labels(names, lv + ('+Inf',))} {v[-1]}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, lv)} {v[-2]}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, lv)} {v[-1]}"
+
+HANDLER_SECONDS  = Histogram("unclebot_handler_seconds", "Handler latency", ["handler"])
+HANDLER_ERRORS   = Counter("unclebot_handler_errors_total", "Handler exceptions", ["handler"])
+DB_SECONDS       = Histogram("unclebot_db_seconds", "DB call latency", ["op"])
+DB_ERRORS        = Counter("unclebot_db_errors_total", "DB call errors", ["op"])
+PROVIDER_SECONDS = Histogram("unclebot_provider_seconds", "Photo provider latency", ["provider", "outcome"])
+TG_SECONDS       = Histogram("unclebot_telegram_seconds", "Telegram Bot API latency", ["method"])
+TG_REQUESTS      = Counter("unclebot_telegram_requests_total", "Telegram Bot API calls", ["method"])
+TG_ERRORS        = Counter("unclebot_telegram_errors_total", "Telegram Bot API errors", ["method", "error"])
+CACHE_LOOKUPS    = Counter("unclebot_cache_lookups_total", "Cache lookups", ["cache", "result"])
+
+def gauge(name, help_):
+    def register(fn):
+        METRIC_GAUGES.append((name, help_, fn))
+        return fn
+    return register
+
+def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    for name, help_, fn in METRIC_GAUGES:
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} gauge")
+        try:
+            for labels, value in fn():
+                lines.append(f"{name}{_fmt_labels(tuple(labels), tuple(labels.values()))} {value}")
+        except Exception as e:
+            logging.warning("gauge %s failed: %s", name, e)
+    return "\n".join(lines) + "\n"
+
+def timed(name: str):
+    """دکوراتور: زمان و خطای هر handler در HANDLER_SECONDS/HANDLER_ERRORS."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - t0, name)
+        return wrapper
+    return deco
+
+async def _metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+METRICS_RUNNER = None
+
+async def start_metrics_server():
+    global METRICS_RUNNER
+    if METRICS_PORT <= 0:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    span = METRICS_PORT_SPAN if CLUSTER_MODE == "multi" else 1
+    for port in range(METRICS_PORT, METRICS_PORT + span):
+        try:
+            await web.TCPSite(runner, METRICS_HOST, port).start()
+        except OSError as e:
+            last = e
+            continue
+        METRICS_RUNNER = runner
+        logging.info("Metrics on http://%s:%s/metrics", METRICS_HOST, port)
+        return
+    # متریک اختیاری است؛ نبودنش نباید پروسه را از کار بیندازد
+    logging.warning("Metrics server disabled: cannot bind %s:%s-%s (%s)",
+                    METRICS_HOST, METRICS_PORT, METRICS_PORT + span - 1, last)
+    await runner.cleanup()
+
+async def stop_metrics_server():
+    if METRICS_RUNNER is not None:
+        await METRICS_RUNNER.cleanup()
+
+class InstrumentedBot(Bot):
+    """همهٔ متدهای Bot API از request رد می‌شوند؛ شمارش/زمان/خطا همین‌جا ثبت می‌شود."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        TG_REQUESTS.inc(method)
+        t0 = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            TG_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            TG_SECONDS.observe(time.perf_counter() - t0, method)
+
 # ---------- Bot ----------
-bot = Bot(token=BOT_TOKEN)
+bot = InstrumentedBot(
+    token=BOT_TOKEN,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION,
+)
 dp  = Dispatcher(bot)
 
 # ---------- UI ----------
@@ -73,39 +246,243 @@ def join_keyboard():
     kb.add(InlineKeyboardButton("✅ عضو شدم عمو جون", callback_data="check_join"))
     return kb
 
-# آلبوم ادمین (برای /send آلبومی)
-ALBUM_CACHE = defaultdict(lambda: {"ts": 0, "media": []})
+# ---------- Expiring state store ----------
+# حالت‌های موقت کاربر (مود جستجو، آلبوم ادمین) در یک key/value با انقضا نگه داشته می‌شوند.
+# backend پیش‌فرض در حافظه است؛ با STATE_BACKEND=postgres بین چند پروسه مشترک می‌شود.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()  # memory | postgres
+# multi: چند پروسه/هاست پشت یک ربات؛ state در Postgres و کارهای پس‌زمینه فقط روی leader
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "single").lower()    # single | multi
+STATE_MAX_KEYS = int(os.getenv("STATE_MAX_KEYS", "100000"))
+STATE_SWEEP_EVERY = 5  # seconds
+
+class MemoryStateBackend:
+    """انقضا با timer wheel ثانیه‌ای (O(1) برای set/touch) + سقف اندازه با LRU."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._data = OrderedDict()          # (ns, key) -> (expires_at, value)
+        self._wheel = defaultdict(set)      # int(expires_at) -> {(ns, key)}
+        self._swept_until = int(time.time())
+
+    def _unschedule(self, k):
+        item = self._data.get(k)
+        if item is not None:
+            slot = self._wheel.get(int(item[0]))
+            if slot is not None:
+                slot.discard(k)
+                if not slot:
+                    del self._wheel[int(item[0])]
+
+    def _put(self, k, value, ttl):
+        self._unschedule(k)
+        expires = time.time() + ttl
+        self._data[k] = (expires, value)
+        self._data.move_to_end(k)
+        self._wheel[int(expires)].add(k)
+        while len(self._data) > self.max_keys:
+            old = next(iter(self._data))
+            self._unschedule(old)
+            del self._data[old]
+
+    def _live(self, k):
+        item = self._data.get(k)
+        if item is None:
+            return None
+        if item[0] <= time.time():
+            self._unschedule(k)
+            del self._data[k]
+            return None
+        return item
+
+    async def get(self, ns, key):
+        item = self._live((ns, key))
+        return None if item is None else item[1]
+
+    async def set(self, ns, key, value, ttl):
+        self._put((ns, key), value, ttl)
+
+    async def touch(self, ns, key, ttl) -> bool:
+        item = self._live((ns, key))
+        if item is None:
+            return False
+        self._put((ns, key), item[1], ttl)
+        return True
+
+    async def append(self, ns, key, item, ttl) -> list:
+        cur = self._live((ns, key))
+        value = (cur[1] if cur else []) + [item]
+        self._put((ns, key), value, ttl)
+        return value
+
+    async def delete(self, ns, key):
+        self._unschedule((ns, key))
+        self._data.pop((ns, key), None)
+
+    async def sweep(self) -> int:
+        now = int(time.time())
+        removed = 0
+        for sec in range(self._swept_until, now):
+            for k in self._wheel.pop(sec, ()):
+                if k in self._data:
+                    del self._data[k]
+                    removed += 1
+        self._swept_until = max(self._swept_until, now)
+        return removed
+
+class PostgresStateBackend:
+    """همان API روی جدول state_store (مقادیر JSON)؛ برای اجرای چندپروسه‌ای."""
+
+    async def get(self, ns, key):
+        v = await db_fetchval(
+            "SELECT value FROM state_store WHERE ns=$1 AND key=$2 AND expires_at > now()", ns, key
+        )
+        return None if v is None else json.loads(v)
+
+    async def set(self, ns, key, value, ttl):
+        await db_execute(
+            """INSERT INTO state_store(ns, key, value, expires_at)
+               VALUES($1, $2, $3::jsonb, now() + make_interval(secs => $4))
+               ON CONFLICT (ns, key) DO UPDATE SET value=EXCLUDED.value, expires_at=EXCLUDED.expires_at""",
+            ns, key, json.dumps(value), ttl
+        )
+
+    async def touch(self, ns, key, ttl) -> bool:
+        r = await db_fetchval(
+            """UPDATE state_store SET expires_at = now() + make_interval(secs => $3)
+               WHERE ns=$1 AND key=$2 AND expires_at > now() RETURNING 1""",
+            ns, key, ttl
+        )
+        return bool(r)
+
+    async def append(self, ns, key, item, ttl) -> list:
+        v = await db_fetchval(
+            """INSERT INTO state_store(ns, key, value, expires_at)
+               VALUES($1, $2, jsonb_build_array($3::jsonb), now() + make_interval(secs => $4))
+               ON CONFLICT (ns, key) DO UPDATE SET
+                 value = CASE WHEN state_store.expires_at > now() THEN state_store.value ELSE '[]'::jsonb END
+                         || EXCLUDED.value,
+                 expires_at = EXCLUDED.expires_at
+               RETURNING value""",
+            ns, key, json.dumps(item), ttl
+        )
+        return json.loads(v)
+
+    async def delete(self, ns, key):
+        await db_execute("DELETE FROM state_store WHERE ns=$1 AND key=$2", ns, key)
+
+    async def sweep(self) -> int:
+        r = await db_execute("DELETE FROM state_store WHERE expires_at <= now()")
+        return int(r.split()[-1]) if r else 0
+
+class ExpiringStore:
+    """یک namespace با TTL ثابت روی backend مشترک."""
+
+    def __init__(self, ns: str, ttl: int):
+        self.ns = ns
+        self.ttl = ttl
+
+    async def get(self, key):
+        return await STATE.get(self.ns, str(key))
+
+    async def set(self, key, value):
+        await STATE.set(self.ns, str(key), value, self.ttl)
+
+    async def touch(self, key) -> bool:
+        return await STATE.touch(self.ns, str(key), self.ttl)
+
+    async def append(self, key, item) -> list:
+        return await STATE.append(self.ns, str(key), item, self.ttl)
+
+    async def delete(self, key):
+        await STATE.delete(self.ns, str(key))
+
+STATE = MemoryStateBackend(STATE_MAX_KEYS)
+
+def configure_state_backend():
+    global STATE
+    if STATE_BACKEND == "postgres" or CLUSTER_MODE == "multi":
+        if DB_READY:
+            STATE = PostgresStateBackend()
+        else:
+            logging.warning("STATE_BACKEND=postgres but DB is not ready; using memory.")
+
+async def state_sweep_loop():
+    while True:
+        await asyncio.sleep(STATE_SWEEP_EVERY if isinstance(STATE, MemoryStateBackend) else 60)
+        try:
+            await STATE.sweep()
+        except Exception as e:
+            logging.warning("state sweep failed: %s", e)
+
+# آلبوم ادمین (برای /send آلبومی): gid -> [{"file_id", "caption"}, ...]
 ALBUM_CACHE_TTL = 600  # seconds
+ALBUM_CACHE = ExpiringStore("album", ALBUM_CACHE_TTL)
 
-# ---------- Search Mode (in-memory) ----------
-SEARCH_MODE = {}         # user_id -> last_activity_ts
+# ---------- Search Mode ----------
 SEARCH_TIMEOUT = 600     # seconds
+SEARCH_MODE = ExpiringStore("search_mode", SEARCH_TIMEOUT)
 
-def enter_search_mode(user_id: int):
-    SEARCH_MODE[user_id] = time.time()
+async def enter_search_mode(user_id: int):
+    await SEARCH_MODE.set(user_id, True)
 
-def exit_search_mode(user_id: int):
-    SEARCH_MODE.pop(user_id, None)
+async def exit_search_mode(user_id: int):
+    await SEARCH_MODE.delete(user_id)
 
-def in_search_mode(user_id: int) -> bool:
-    ts = SEARCH_MODE.get(user_id)
-    if not ts:
-        return False
-    if time.time() - ts > SEARCH_TIMEOUT:
-        SEARCH_MODE.pop(user_id, None)
-        return False
-    SEARCH_MODE[user_id] = time.time()  # touch
-    return True
+async def in_search_mode(user_id: int) -> bool:
+    # هر پیام در مود جستجو تایم‌اوت را تمدید می‌کند
+    return await SEARCH_MODE.touch(user_id)
 
 # ---------- Helpers ----------
 def _is_english(text: str) -> bool:
     # اگر تمام کاراکترها ASCII باشند، متن را انگلیسی در نظر می‌گیریم
     return all(ch.isascii() for ch in (text or ""))
 
+def normalize_query(text: str) -> str:
+    # کوچک‌حرف + فاصله‌های اضافه حذف؛ کلید مشترک کش و تاریخچه
+    return " ".join((text or "").lower().split())
+
+# ---------- Rate limiting ----------
+class TokenBucket:
+    """Token bucket ساده (async) برای ماندن زیر سقف نرخ API تلگرام."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """بعد از RetryAfter همهٔ ارسال‌ها تا پایان flood-wait صبر می‌کنند."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, n: float = 1):
+        n = min(float(n), self.capacity)
+        async with self._lock:  # FIFO: منتظرها به ترتیب نوبت می‌گیرند
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                await asyncio.sleep((n - self.tokens) / self.rate)
+
+# سقف سراسری تلگرام حدود ۳۰ پیام در ثانیه است؛ کمی پایین‌تر می‌مانیم
+TG_BULK_RATE = float(os.getenv("TG_BULK_RATE", "25"))
+TG_BULK_BUCKET = TokenBucket(TG_BULK_RATE)
+
 # ---------- DB ----------
 PG_POOL = None
 DB_READY = False
 LAST_DB_ERROR = None  # برای /pgdiag
+SCHEMA_APPLIED = False
+PG_SSL = None  # SSL context اتصالی که موفق شد (برای کانکشن‌های جدا مثل LISTEN)
+PG_SSL_MODE = None  # "ssl" | "plain"؛ حالتی که موفق شد تا reconnect مستقیم همان را بزند
 
 SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS users (
@@ -119,6 +496,14 @@ CREATE TABLE IF NOT EXISTS posted_photos (
   message_id BIGINT PRIMARY KEY,
   added_at   TIMESTAMPTZ DEFAULT now()
 );
+-- کلید تصادفی ثابت برای نمونه‌گیری با ایندکس (به‌جای ORDER BY random())
+ALTER TABLE posted_photos ADD COLUMN IF NOT EXISTS rnd DOUBLE PRECISION NOT NULL DEFAULT random();
+CREATE INDEX IF NOT EXISTS idx_posted_photos_rnd ON posted_photos(rnd);
+-- file_id عکس (از /addphoto) تا ارسال تصادفی با یک send_media_group انجام شود؛ ردیف‌های قدیمی NULL
+ALTER TABLE posted_photos ADD COLUMN IF NOT EXISTS file_id TEXT;
+-- کپشن پست خزانه (با entityها) تا ارسال با file_id هم همان کپشن copy_message را داشته باشد
+ALTER TABLE posted_photos ADD COLUMN IF NOT EXISTS caption TEXT;
+ALTER TABLE posted_photos ADD COLUMN IF NOT EXISTS caption_entities JSONB;
 
 CREATE TABLE IF NOT EXISTS used_photos (
   user_id    BIGINT,
@@ -129,19 +514,140 @@ CREATE TABLE IF NOT EXISTS used_photos (
 );
 CREATE INDEX IF NOT EXISTS idx_used_photos_user ON used_photos(user_id);
 
-CREATE TABLE IF NOT EXISTS search_history (
-  user_id BIGINT,
-  query   TEXT,
-  url     TEXT,
-  seen_at TIMESTAMPTZ DEFAULT now(),
-  PRIMARY KEY (user_id, query, url)
-);
-CREATE INDEX IF NOT EXISTS idx_search_history_user_query_url ON search_history(user_id, query, url);
+-- تاریخچهٔ جستجو به‌صورت فشرده: هش ۶۴ بیتی query/url به‌جای متن کامل،
+-- پارتیشن ماهانه روی seen_at تا نگهداری (retention) فقط DROP یک پارتیشن باشد.
+-- (جدول قدیمی search_history یک‌بار به اینجا منتقل و حذف می‌شود؛ migrate_search_history)
+CREATE OR REPLACE FUNCTION hash64(t TEXT) RETURNS BIGINT
+  LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+  AS $$ SELECT ('x' || substr(md5(t), 1, 16))::bit(64)::bigint $$;
+
+CREATE TABLE IF NOT EXISTS search_seen (
+  user_id BIGINT NOT NULL,
+  qhash   BIGINT NOT NULL,
+  uhash   BIGINT NOT NULL,
+  seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+) PARTITION BY RANGE (seen_at);
+CREATE TABLE IF NOT EXISTS search_seen_default PARTITION OF search_seen DEFAULT;
+CREATE INDEX IF NOT EXISTS idx_search_seen_lookup ON search_seen(user_id, qhash, uhash);
+CREATE INDEX IF NOT EXISTS idx_search_seen_seen_at ON search_seen USING brin(seen_at);
+-- پارتیشن ماه جاری و بعدی همین‌جا (قبل از هر handler) ساخته می‌شود؛ وگرنه ردیف‌ها در
+-- default می‌نشینند و retention هیچ‌وقت پاکشان نمی‌کند. ردیف‌هایی که قبلاً آنجا نشسته‌اند
+-- به پارتیشن تازه منتقل می‌شوند (ساخت مستقیم PARTITION OF در این حالت خطا می‌دهد).
+DO $$
+DECLARE
+  m    DATE;
+  name TEXT;
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext('search_seen_partitions'));
+  FOR i IN 0..1 LOOP
+    m := (date_trunc('month', now()) + make_interval(months => i))::date;
+    name := 'search_seen_p' || to_char(m, 'YYYYMM');
+    IF to_regclass(name) IS NULL THEN
+      EXECUTE format('CREATE TABLE %I (LIKE search_seen INCLUDING DEFAULTS)', name);
+      EXECUTE format('WITH moved AS (DELETE FROM search_seen_default WHERE seen_at >= %L AND seen_at < %L RETURNING *) '
+                     'INSERT INTO %I SELECT * FROM moved', m, m + interval '1 month', name);
+      EXECUTE format('ALTER TABLE search_seen ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                     name, m, (m + interval '1 month')::date);
+    END IF;
+  END LOOP;
+END $$;
 
 CREATE TABLE IF NOT EXISTS admins (
   user_id  BIGINT PRIMARY KEY,
   added_at TIMESTAMPTZ DEFAULT now()
 );
+
+-- ارسال همگانی: هر job + وضعیت تک‌تک گیرنده‌ها (برای ادامه بعد از ری‌استارت)
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+  job_id        BIGSERIAL PRIMARY KEY,
+  admin_chat_id BIGINT NOT NULL,
+  from_chat_id  BIGINT,
+  message_id    BIGINT,
+  media         TEXT,                 -- JSON: [{"file_id": ..., "caption": ...}] برای آلبوم
+  status        TEXT NOT NULL DEFAULT 'running',   -- running / done
+  created_at    TIMESTAMPTZ DEFAULT now(),
+  finished_at   TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+  job_id   BIGINT REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE,
+  user_id  BIGINT,
+  status   TEXT NOT NULL DEFAULT 'pending',        -- pending / sent / failed
+  attempts SMALLINT NOT NULL DEFAULT 0,
+  error    TEXT,
+  PRIMARY KEY (job_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_broadcast_pending ON broadcast_recipients(job_id, user_id) WHERE status='pending';
+
+-- وضعیت‌های کوچک key/value (مثلاً checkpoint پاکسازی خزانه)
+CREATE TABLE IF NOT EXISTS kv_state (
+  key        TEXT PRIMARY KEY,
+  value      TEXT,
+  updated_at TIMESTAMPTZ DEFAULT now()
+);
+
+-- شمارندهٔ روزانهٔ جستجوها (برای /topqueries؛ هر جستجو یک واحد)
+CREATE TABLE IF NOT EXISTS search_daily (
+  day      DATE,
+  query    TEXT,
+  searches INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, query)
+);
+
+-- حالت‌های موقت مشترک بین پروسه‌ها (STATE_BACKEND=postgres)
+CREATE TABLE IF NOT EXISTS state_store (
+  ns         TEXT,
+  key        TEXT,
+  value      JSONB,
+  expires_at TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS idx_state_store_expires ON state_store(expires_at);
+
+-- صف آپدیت‌ها در حالت چندپروسه‌ای (CLUSTER_MODE=multi)
+CREATE TABLE IF NOT EXISTS update_inbox (
+  id         BIGSERIAL PRIMARY KEY,
+  user_key   TEXT NOT NULL,
+  payload    JSONB NOT NULL,
+  claimed_by TEXT,
+  claimed_at TIMESTAMPTZ,
+  created_at TIMESTAMPTZ DEFAULT now()
+);
+-- update_id یکتا: همان آپدیت (poll دوباره بعد از failover، retry وبهوک) دوبار ثبت نمی‌شود.
+-- ردیف پردازش‌شده با done_at می‌ماند تا تکرار دیرهنگام هم کنار گذاشته شود.
+ALTER TABLE update_inbox ADD COLUMN IF NOT EXISTS update_id BIGINT;
+ALTER TABLE update_inbox ADD COLUMN IF NOT EXISTS done_at TIMESTAMPTZ;
+CREATE UNIQUE INDEX IF NOT EXISTS uq_update_inbox_update_id ON update_inbox(update_id);
+DROP INDEX IF EXISTS idx_update_inbox_user;
+CREATE INDEX IF NOT EXISTS idx_update_inbox_pending ON update_inbox(user_key, id) WHERE done_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_update_inbox_done ON update_inbox(done_at) WHERE done_at IS NOT NULL;
+
+-- URL عکس provider -> file_id تلگرام (برای ارسال دوبارهٔ همان عکس بدون دانلود مجدد)
+CREATE TABLE IF NOT EXISTS photo_file_ids (
+  url       TEXT PRIMARY KEY,
+  file_id   TEXT NOT NULL,
+  cached_at TIMESTAMPTZ DEFAULT now()
+);
+
+-- لایهٔ دوم کش نتایج جستجو (اختیاری، SEARCH_CACHE_PG=1)، جدا برای هر provider.
+-- نسخهٔ قدیمی بدون ستون provider فقط کش است؛ دور ریخته و از نو ساخته می‌شود.
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM information_schema.tables
+             WHERE table_schema = current_schema() AND table_name = 'search_cache')
+     AND NOT EXISTS (SELECT 1 FROM information_schema.columns
+             WHERE table_schema = current_schema() AND table_name = 'search_cache' AND column_name = 'provider') THEN
+    DROP TABLE search_cache;
+  END IF;
+END $$;
+CREATE TABLE IF NOT EXISTS search_cache (
+  query      TEXT,
+  page       INT,
+  provider   TEXT,
+  urls       TEXT[] NOT NULL,
+  fetched_at TIMESTAMPTZ DEFAULT now(),
+  PRIMARY KEY (query, page, provider)
+);
 """
 
 def _build_dsn_from_parts():
@@ -163,21 +669,75 @@ def _mask_dsn(dsn: str) -> str:
     except:
         return "***"
 
+# ---------- Pool config ----------
+# پشت pooler حالت transaction (PgBouncer، Supabase pooler، ...) prepared statementهای
+# نام‌دار بین تراکنش‌ها جابه‌جا می‌شوند، پس فقط آنجا cache خاموش می‌شود. در اتصال مستقیم
+# asyncpg کوئری‌های داغ (pick_unseen_for_user، mark_used، seen-URLها) را یک بار prepare می‌کند.
+PG_POOLER = os.getenv("PG_POOLER", "auto").lower()  # auto | none | transaction
+PG_POOLER_PORTS = {6432, 6543}                      # PgBouncer / Supabase pooler
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "0"))    # 0 = از MAX_INFLIGHT_UPDATES
+PG_MAX_INACTIVE_LIFETIME = float(os.getenv("PG_MAX_INACTIVE_LIFETIME", "300"))
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+PG_BEHIND_POOLER = False
+
+def _resolve_pooler(dsn: str):
+    """pooler را از env یا DSN تشخیص بده؛ پارامتر pgbouncer=… را (که asyncpg نمی‌شناسد) حذف کن."""
+    u = urlparse(dsn)
+    params = [(k, v) for k, v in parse_qsl(u.query, keep_blank_values=True)]
+    flag = any(k == "pgbouncer" and v.lower() in ("1", "true", "yes") for k, v in params)
+    stripped = urlunparse(u._replace(query=urlencode([(k, v) for k, v in params if k != "pgbouncer"])))
+    if PG_POOLER == "transaction":
+        return stripped, True
+    if PG_POOLER == "none":
+        return stripped, False
+    try:
+        port = u.port
+    except ValueError:
+        port = None
+    detected = flag or port in PG_POOLER_PORTS or "pooler" in (u.hostname or "")
+    return stripped, detected
+
+def _pool_max_size() -> int:
+    if PG_POOL_MAX > 0:
+        return PG_POOL_MAX
+    # هر آپدیت در حال اجرا معمولاً ۲-۳ کوئری کوتاه دارد (bench/bench_load.py)؛ یک اتصال
+    # به ازای هر ۴ آپدیت هم‌زمان + چند اتصال برای write-behind و کارهای پس‌زمینه کافی است.
+    return max(PG_POOL_MIN, min(20, MAX_INFLIGHT_UPDATES // 4 + 4))
+
+def pool_config_text() -> str:
+    return (f"pooler={'transaction' if PG_BEHIND_POOLER else 'none'} "
+            f"size={PG_POOL_MIN}..{_pool_max_size()} "
+            f"stmt_cache={0 if PG_BEHIND_POOLER else PG_STATEMENT_CACHE_SIZE}")
+
 async def _create_pool(dsn: str, ssl_ctx):
     # پارامترهای پایداری برای جلوگیری از reset by peer
     return await asyncpg.create_pool(
         dsn,
-        min_size=1,
-        max_size=5,
+        min_size=PG_POOL_MIN,
+        max_size=_pool_max_size(),
         ssl=ssl_ctx,
         command_timeout=30,
-        max_inactive_connection_lifetime=60,
-        statement_cache_size=0,
+        max_inactive_connection_lifetime=PG_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=0 if PG_BEHIND_POOLER else PG_STATEMENT_CACHE_SIZE,
     )
 
+async def _apply_schema():
+    """جداول/ایندکس‌ها را (idempotent) بساز؛ خطا فقط لاگ می‌شود."""
+    global LAST_DB_ERROR, SCHEMA_APPLIED
+    if SCHEMA_APPLIED:
+        return
+    try:
+        async with PG_POOL.acquire() as conn:
+            await conn.execute(SCHEMA_SQL)
+        SCHEMA_APPLIED = True
+    except Exception as e:
+        LAST_DB_ERROR = f"Schema apply failed: {e}"
+        logging.exception("Schema apply failed: %s", e)
+
 async def safe_init_db():
     """Init DB safely with SSL/Non-SSL fallback and clear logs."""
-    global DB_READY, PG_DSN, LAST_DB_ERROR, PG_POOL
+    global DB_READY, PG_DSN, LAST_DB_ERROR, PG_POOL, PG_SSL, PG_SSL_MODE, PG_BEHIND_POOLER
     LAST_DB_ERROR = None
 
     # اگر DATABASE_URL نبود، از قطعات بساز
@@ -190,8 +750,12 @@ async def safe_init_db():
         logging.error("DATABASE_URL not set and no PGHOST/PGUSER/… found.")
         return
 
+    PG_DSN, PG_BEHIND_POOLER = _resolve_pooler(PG_DSN)
     masked = _mask_dsn(PG_DSN)
-    logging.info("Trying DB connect: %s", masked)
+    logging.info("Trying DB connect: %s (%s)", masked, pool_config_text())
+    if PG_BEHIND_POOLER and CLUSTER_MODE == "multi":
+        logging.warning("CLUSTER_MODE=multi needs LISTEN and session advisory locks; "
+                        "use a direct (non transaction-pooled) DATABASE_URL.")
 
     # 1) تست با SSL
     try:
@@ -200,7 +764,9 @@ async def safe_init_db():
         async with PG_POOL.acquire() as conn:
             await conn.execute("SELECT 1")
         DB_READY = True
+        PG_SSL, PG_SSL_MODE = ssl_ctx, "ssl"
         logging.info("DB connected with SSL.")
+        await _apply_schema()
         return
     except Exception as e_ssl:
         logging.warning("DB SSL connect failed: %s", e_ssl)
@@ -212,102 +778,559 @@ async def safe_init_db():
         async with PG_POOL.acquire() as conn:
             await conn.execute("SELECT 1")
         DB_READY = True
+        PG_SSL, PG_SSL_MODE = None, "plain"
         LAST_DB_ERROR = None
         logging.info("DB connected WITHOUT SSL.")
+        await _apply_schema()
         return
     except Exception as e_nossl:
         DB_READY = False
         LAST_DB_ERROR = f"Non-SSL connect failed: {e_nossl}"
         logging.exception("DB init failed (no SSL): %s", e_nossl)
 
-async def _recreate_pool():
-    global PG_POOL
-    if PG_POOL:
+# ---------- Reconnect ----------
+# خطای اتصال در db_* فقط یک reconnect (single-flight) راه می‌اندازد. اگر اولین تلاش
+# موفق نشد، circuit breaker باز می‌شود: DB_READY=False و همهٔ فراخوانی‌ها فوراً
+# DBUnavailable می‌گیرند تا حلقهٔ پس‌زمینه با backoff تصادفی دوباره وصل شود.
+DB_RECONNECT_BASE = float(os.getenv("DB_RECONNECT_BASE", "0.5"))  # seconds
+DB_RECONNECT_MAX = float(os.getenv("DB_RECONNECT_MAX", "30"))
+DB_RECONNECT_WAIT = 5  # seconds؛ صبر caller برای اولین تلاش قبل از fail fast
+DB_RECONNECT_TASK = None
+DB_RECONNECT_FIRST = None  # Future: نتیجهٔ اولین تلاشِ reconnect جاری
+# فقط خطای خودِ اتصال؛ timeout کوئری (command_timeout / statement_timeout) و خطای
+# داده‌ای سمت کلاینت (InterfaceError) همان‌طور بالا می‌روند و pool را عوض نمی‌کنند.
+DB_CONN_ERRORS = (
+    ConnectionError, OSError,
+    asyncpg.PostgresConnectionError,  # شامل ConnectionDoesNotExistError
+    asyncpg.exceptions.CannotConnectNowError,
+    asyncpg.exceptions.AdminShutdownError, asyncpg.exceptions.CrashShutdownError,
+)
+
+class DBUnavailable(ConnectionError):
+    """دیتابیس در حال reconnect است؛ بدون تلاش دوباره خطا بده."""
+
+def db_breaker_open() -> bool:
+    return not DB_READY and DB_RECONNECT_TASK is not None and not DB_RECONNECT_TASK.done()
+
+async def _close_pool(pool):
+    try:
+        await asyncio.wait_for(pool.close(), 10)
+    except Exception:
+        pool.terminate()
+
+async def _reopen_pool():
+    """pool تازه با همان حالت SSL که قبلاً جواب داده (اگر معلوم نیست: اول SSL بعد بدون SSL)."""
+    global PG_POOL, PG_SSL, PG_SSL_MODE, DB_READY, LAST_DB_ERROR
+    modes = [PG_SSL_MODE] if PG_SSL_MODE else ["ssl", "plain"]
+    last = None
+    for mode in modes:
+        ssl_ctx = ssl.create_default_context() if mode == "ssl" else None
         try:
-            await PG_POOL.close()
-        except:
-            pass
-    PG_POOL = None
-    await safe_init_db()
+            pool = await _create_pool(PG_DSN, ssl_ctx)
+        except Exception as e:
+            last = e
+            continue
+        old, PG_POOL = PG_POOL, pool
+        PG_SSL, PG_SSL_MODE = ssl_ctx, mode
+        DB_READY, LAST_DB_ERROR = True, None
+        if old is not None:
+            asyncio.create_task(_close_pool(old))
+        await _apply_schema()
+        return
+    raise last
 
-async def db_execute(sql, *args):
+async def _reconnect_loop(first: asyncio.Future):
+    global DB_READY, LAST_DB_ERROR
+    attempt = 0
+    while True:
+        try:
+            await _reopen_pool()
+            if not first.done():
+                first.set_result(True)
+            if attempt:
+                logging.info("DB reconnected after %d failed attempts", attempt)
+            return
+        except Exception as e:
+            attempt += 1
+            DB_READY = False
+            if not first.done():
+                first.set_result(False)
+            LAST_DB_ERROR = f"reconnect failed: {e}"
+            delay = min(DB_RECONNECT_MAX, DB_RECONNECT_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            logging.warning("DB reconnect attempt %d failed (%s); next in %.1fs", attempt, e, delay)
+            await asyncio.sleep(delay)
+
+async def _db_recover(failed_pool, error):
+    global DB_RECONNECT_TASK, DB_RECONNECT_FIRST
+    if PG_POOL is not failed_pool and DB_READY:
+        return  # یک نفر دیگر قبلاً pool را عوض کرده
+    if DB_RECONNECT_TASK is None or DB_RECONNECT_TASK.done():
+        logging.warning("DB connection error, reconnecting: %s", error)
+        DB_RECONNECT_FIRST = asyncio.get_running_loop().create_future()
+        DB_RECONNECT_TASK = asyncio.create_task(_reconnect_loop(DB_RECONNECT_FIRST))
+    elif not DB_READY:
+        raise DBUnavailable(LAST_DB_ERROR or "database unavailable")
     try:
+        ok = await asyncio.wait_for(asyncio.shield(DB_RECONNECT_FIRST), DB_RECONNECT_WAIT)
+    except asyncio.TimeoutError:
+        ok = False
+    if not ok:
+        raise DBUnavailable(LAST_DB_ERROR or "database unavailable")
+
+async def _db_call(method: str, sql, args):
+    if db_breaker_open():
+        raise DBUnavailable(LAST_DB_ERROR or "database unavailable")
+    pool = PG_POOL
+    try:
+        async with pool.acquire() as conn:
+            return await getattr(conn, method)(sql, *args)
+    except asyncio.TimeoutError:
+        raise  # از ۳.۱۱ زیرکلاس OSError است ولی یعنی کوئری کند، نه اتصال قطع
+    except DB_CONN_ERRORS as e:
+        await _db_recover(pool, e)
         async with PG_POOL.acquire() as conn:
-            return await conn.execute(sql, *args)
-    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
-        logging.warning("db_execute retry after pool recreate: %s", e)
-        await _recreate_pool()
-        async with PG_POOL.acquire() as conn:
-            return await conn.execute(sql, *args)
+            return await getattr(conn, method)(sql, *args)
 
+def timed_db(op: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args)
+            except Exception:
+                DB_ERRORS.inc(op)
+                raise
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - t0, op)
+        return wrapper
+    return deco
+
+@gauge("unclebot_db_pool_connections", "asyncpg pool connections by state")
+def _pool_gauge():
+    if PG_POOL is None:
+        return []
+    size, idle = PG_POOL.get_size(), PG_POOL.get_idle_size()
+    return [({"state": "in_use"}, size - idle), ({"state": "idle"}, idle),
+            ({"state": "max"}, PG_POOL.get_max_size())]
+
+@timed_db("execute")
+async def db_execute(sql, *args):
+    return await _db_call("execute", sql, args)
+
+@timed_db("fetch")
 async def db_fetch(sql, *args):
-    try:
-        async with PG_POOL.acquire() as conn:
-            return await conn.fetch(sql, *args)
-    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
-        logging.warning("db_fetch retry after pool recreate: %s", e)
-        await _recreate_pool()
-        async with PG_POOL.acquire() as conn:
-            return await conn.fetch(sql, *args)
+    return await _db_call("fetch", sql, args)
 
+@timed_db("fetchval")
 async def db_fetchval(sql, *args):
-    try:
-        async with PG_POOL.acquire() as conn:
-            return await conn.fetchval(sql, *args)
-    except (asyncpg.PostgresError, ConnectionError, OSError) as e:
-        logging.warning("db_fetchval retry after pool recreate: %s", e)
-        await _recreate_pool()
-        async with PG_POOL.acquire() as conn:
-            return await conn.fetchval(sql, *args)
+    return await _db_call("fetchval", sql, args)
+
+# ---------- Write-behind buffer ----------
+WB_FLUSH_MS  = int(os.getenv("WB_FLUSH_MS", "500"))
+WB_MAX_ROWS  = int(os.getenv("WB_MAX_ROWS", "500"))
+WB_QUEUE_MAX = int(os.getenv("WB_QUEUE_MAX", "20000"))
+WB_FLUSH_RETRIES = 3
+
+class WriteBehind:
+    """نوشتن تأخیری: ردیف‌های کوچک در صف جمع، هم‌کلیدها ادغام و با یک دستور چندردیفه flush می‌شوند.
+
+    put فقط وقتی صبر می‌کند که صف پر باشد (DB گیر کرده) — همان backpressure.
+    """
+
+    def __init__(self, name, flush_fn, key_fn, merge_fn=None):
+        self.name = name
+        self.flush_fn = flush_fn  # async (rows: list) -> None
+        self.key_fn = key_fn
+        self.merge_fn = merge_fn or (lambda old, new: new)  # پیش‌فرض: آخری برنده است
+        self.queue = asyncio.Queue(maxsize=WB_QUEUE_MAX)
+        self._pending = {}
+        self._full = asyncio.Event()
+        self._task = None
+
+    async def put(self, row):
+        await self.queue.put(row)
+        if self.queue.qsize() >= WB_MAX_ROWS:
+            self._full.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _add(self, row):
+        key = self.key_fn(row)
+        old = self._pending.get(key)
+        self._pending[key] = row if old is None else self.merge_fn(old, row)
+
+    def _drain(self, limit):
+        while len(self._pending) < limit and not self.queue.empty():
+            self._add(self.queue.get_nowait())
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        rows = list(self._pending.values())
+        for attempt in range(1, WB_FLUSH_RETRIES + 1):
+            try:
+                await self.flush_fn(rows)
+                break
+            except Exception as e:
+                logging.warning("write-behind %s flush failed (%s/%s): %s", self.name, attempt, WB_FLUSH_RETRIES, e)
+                if attempt == WB_FLUSH_RETRIES:
+                    logging.error("write-behind %s dropped %s rows", self.name, len(rows))
+                else:
+                    await asyncio.sleep(attempt)
+        self._pending = {}
+
+    async def _run(self):
+        while True:
+            self._add(await self.queue.get())
+            # تا WB_FLUSH_MS یا رسیدن به WB_MAX_ROWS صبر کن
+            try:
+                await asyncio.wait_for(self._full.wait(), WB_FLUSH_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            self._drain(WB_MAX_ROWS)
+            await self._flush()
+            if self.queue.qsize() >= WB_MAX_ROWS:
+                self._full.set()
+
+    async def close(self):
+        """در shutdown: تسک را متوقف و همه‌چیز باقی‌مانده را flush کن."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        while self._pending or not self.queue.empty():
+            self._drain(WB_MAX_ROWS)
+            await self._flush()
+
+async def _flush_users(rows):
+    await db_execute(
+        """INSERT INTO users(user_id,name,username)
+           SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[])
+           ON CONFLICT (user_id) DO UPDATE SET name=EXCLUDED.name, username=EXCLUDED.username""",
+        [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]
+    )
+
+async def _flush_used(rows):
+    # عکسی که در این فاصله از خزانه حذف شده، کل batch را خراب نکند (FK)
+    await db_execute(
+        """INSERT INTO used_photos(user_id,message_id)
+           SELECT v.user_id, v.message_id
+           FROM unnest($1::bigint[], $2::bigint[]) AS v(user_id, message_id)
+           WHERE EXISTS (SELECT 1 FROM posted_photos p WHERE p.message_id=v.message_id)
+           ON CONFLICT DO NOTHING""",
+        [r[0] for r in rows], [r[1] for r in rows]
+    )
+
+async def _flush_search_daily(rows):
+    await db_execute(
+        """INSERT INTO search_daily(day, query, searches)
+           SELECT * FROM unnest($1::date[], $2::text[], $3::int[])
+           ON CONFLICT (day, query) DO UPDATE SET searches = search_daily.searches + EXCLUDED.searches""",
+        [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]
+    )
+
+USERS_WB = WriteBehind("users", _flush_users, key_fn=lambda r: r[0])
+USED_WB  = WriteBehind("used_photos", _flush_used, key_fn=lambda r: r)
+SEARCH_DAILY_WB = WriteBehind(
+    "search_daily", _flush_search_daily,
+    key_fn=lambda r: (r[0], r[1]),
+    merge_fn=lambda old, new: (old[0], old[1], old[2] + new[2]),
+)
 
 # CRUD helpers
+async def get_state(key: str, default=None):
+    v = await db_fetchval("SELECT value FROM kv_state WHERE key=$1", key)
+    return default if v is None else v
+
+async def set_state(key: str, value):
+    await db_execute(
+        """INSERT INTO kv_state(key, value) VALUES($1,$2)
+           ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=now()""",
+        key, str(value)
+    )
+
 async def upsert_user(u: types.User):
     if not DB_READY: return
+    await USERS_WB.put((u.id, u.full_name, u.username))
+
+async def add_posted_photo(message_id: int, file_id: str = None, caption: str = None, caption_entities=None):
+    entities = json.dumps([e.to_python() for e in caption_entities]) if caption_entities else None
     await db_execute(
-        """INSERT INTO users(user_id,name,username)
-           VALUES($1,$2,$3)
-           ON CONFLICT (user_id) DO UPDATE SET name=EXCLUDED.name, username=EXCLUDED.username""",
-        u.id, u.full_name, u.username
+        """INSERT INTO posted_photos(message_id, file_id, caption, caption_entities) VALUES($1, $2, $3, $4::jsonb)
+           ON CONFLICT (message_id) DO UPDATE SET
+             file_id = COALESCE(EXCLUDED.file_id, posted_photos.file_id),
+             caption = COALESCE(EXCLUDED.caption, posted_photos.caption),
+             caption_entities = COALESCE(EXCLUDED.caption_entities, posted_photos.caption_entities)""",
+        message_id, file_id, caption, entities
     )
 
-async def add_posted_photo(message_id: int):
-    await db_execute("INSERT INTO posted_photos(message_id) VALUES($1) ON CONFLICT DO NOTHING", message_id)
+# از یک نقطهٔ تصادفی روی ایندکس rnd جلو می‌رویم و اولین عکس‌های دیده‌نشده را برمی‌داریم؛
+# اگر تا انتها کم بود، شاخهٔ دوم از ابتدا ادامه می‌دهد (wrap-around). هزینه به اندازهٔ
+# خزانه بستگی ندارد، فقط به نسبت عکس‌های دیده‌شدهٔ همان کاربر.
+PICK_UNSEEN_SQL = """
+(SELECT p.message_id, p.file_id, p.caption, p.caption_entities FROM posted_photos p
+ WHERE p.rnd >= $2
+   AND NOT EXISTS (SELECT 1 FROM used_photos u WHERE u.user_id=$1 AND u.message_id=p.message_id)
+ ORDER BY p.rnd LIMIT $3)
+UNION ALL
+(SELECT p.message_id, p.file_id, p.caption, p.caption_entities FROM posted_photos p
+ WHERE p.rnd < $2
+   AND NOT EXISTS (SELECT 1 FROM used_photos u WHERE u.user_id=$1 AND u.message_id=p.message_id)
+ ORDER BY p.rnd LIMIT $3)
+LIMIT $3
+"""
 
 async def pick_unseen_for_user(user_id: int, limit: int = 3):
-    rows = await db_fetch(
-        """SELECT p.message_id
-           FROM posted_photos p
-           LEFT JOIN used_photos u ON u.message_id=p.message_id AND u.user_id=$1
-           WHERE u.message_id IS NULL
-           ORDER BY random()
-           LIMIT $2""",
-        user_id, limit
-    )
-    return [r["message_id"] for r in rows]
+    """ردیف‌های message_id, file_id (یا None برای ردیف‌های قدیمی), caption, caption_entities"""
+    return await db_fetch(PICK_UNSEEN_SQL, user_id, random.random(), limit)
+
+def _caption_kwargs(row) -> dict:
+    if not row["caption"]:
+        return {}
+    entities = json.loads(row["caption_entities"]) if row["caption_entities"] else None
+    return {
+        "caption": row["caption"],
+        "caption_entities": [types.MessageEntity(**e) for e in entities] if entities else None,
+    }
 
 async def mark_used(user_id: int, message_id: int):
-    await db_execute("INSERT INTO used_photos(user_id,message_id) VALUES($1,$2) ON CONFLICT DO NOTHING", user_id, message_id)
+    await USED_WB.put((user_id, message_id))
+
+async def prune_posted_photos(message_ids: list):
+    if message_ids:
+        await db_execute("DELETE FROM posted_photos WHERE message_id = ANY($1::bigint[])", message_ids)
 
-async def has_seen_url(user_id: int, query: str, url: str) -> bool:
-    rows = await db_fetch("SELECT 1 FROM search_history WHERE user_id=$1 AND query=$2 AND url=$3", user_id, query, url)
-    return bool(rows)
+async def record_search(query: str):
+    await SEARCH_DAILY_WB.put((datetime.date.today(), query, 1))
+
+async def filter_unseen_urls(user_id: int, query: str, urls: list) -> list:
+    """زیرمجموعهٔ دیده‌نشدهٔ urls (با حفظ ترتیب) در یک round trip."""
+    if not urls:
+        return []
+    rows = await db_fetch(
+        """SELECT c.url
+           FROM unnest($3::text[]) WITH ORDINALITY AS c(url, ord)
+           WHERE NOT EXISTS (
+             SELECT 1 FROM search_seen h
+             WHERE h.user_id=$1 AND h.qhash=hash64($2) AND h.uhash=hash64(c.url)
+           )
+           ORDER BY c.ord""",
+        user_id, query, urls
+    )
+    return [r["url"] for r in rows]
 
 async def store_seen_urls(user_id: int, query: str, urls: list):
     if not urls: return
-    async with PG_POOL.acquire() as conn:
-        async with conn.transaction():
-            for u in urls:
+    # کلید یکتا روی جدول پارتیشن‌شده ممکن نیست؛ فقط URLهای فیلترشده (دیده‌نشده) ذخیره می‌شوند
+    await db_execute(
+        """INSERT INTO search_seen(user_id, qhash, uhash)
+           SELECT $1, hash64($2), hash64(u) FROM unnest($3::text[]) AS u""",
+        user_id, query, urls
+    )
+
+# ---------- search_seen partitions / retention ----------
+SEARCH_HISTORY_RETENTION_DAYS = int(os.getenv("SEARCH_HISTORY_RETENTION_DAYS", "180"))
+SEARCH_PARTITIONS_AHEAD = 2  # months
+
+def _month_start(d: datetime.date, delta: int = 0) -> datetime.date:
+    m = d.year * 12 + (d.month - 1) + delta
+    return datetime.date(m // 12, m % 12 + 1, 1)
+
+async def ensure_search_partitions():
+    """پارتیشن‌های ماهانه از ابتدای بازهٔ retention تا چند ماه جلوتر."""
+    today = datetime.date.today()
+    first = _month_start(today - datetime.timedelta(days=SEARCH_HISTORY_RETENTION_DAYS))
+    m = first
+    while m <= _month_start(today, SEARCH_PARTITIONS_AHEAD):
+        nxt = _month_start(m, 1)
+        name = f"search_seen_p{m:%Y%m}"
+        try:
+            await db_execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF search_seen "
+                f"FOR VALUES FROM ('{m}') TO ('{nxt}')"
+            )
+        except asyncpg.PostgresError as e:
+            # مثلاً اگر ردیف‌های این بازه قبلاً در پارتیشن default نشسته باشند
+            logging.warning("create partition %s failed: %s", name, e)
+        m = nxt
+
+async def drop_expired_search_partitions():
+    """retention: پارتیشن‌هایی که کاملاً قدیمی‌تر از بازه‌اند DROP می‌شوند (بدون DELETE)."""
+    cutoff = datetime.date.today() - datetime.timedelta(days=SEARCH_HISTORY_RETENTION_DAYS)
+    rows = await db_fetch(
+        """SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid=i.inhrelid
+           WHERE i.inhparent='search_seen'::regclass"""
+    )
+    for r in rows:
+        name = r["relname"]
+        suffix = name.rsplit("_p", 1)[-1]
+        if not (name.startswith("search_seen_p") and suffix.isdigit() and len(suffix) == 6):
+            continue
+        month = datetime.date(int(suffix[:4]), int(suffix[4:]), 1)
+        if _month_start(month, 1) <= cutoff:
+            await db_execute(f"DROP TABLE IF EXISTS {name}")
+            logging.info("Dropped expired partition %s", name)
+    # هر چه خارج از پارتیشن‌های ماهانه در default مانده، با همان cutoff پاک می‌شود
+    await db_execute("DELETE FROM search_seen_default WHERE seen_at < $1", cutoff)
+
+SEARCH_HISTORY_MIGRATE_BATCH = 5000
+SEARCH_HISTORY_MIGRATE_TASK = None
+
+_MIGRATE_BATCH_SQL = """
+WITH batch AS (
+  SELECT user_id, query, url, seen_at FROM search_history
+  {where}
+  ORDER BY user_id, query, url
+  LIMIT $1
+), ins AS (
+  INSERT INTO search_seen(user_id, qhash, uhash, seen_at)
+  SELECT user_id, hash64(query), hash64(url), COALESCE(seen_at, now()) FROM batch
+  WHERE COALESCE(seen_at, now()) >= now() - make_interval(days => $2)
+)
+SELECT user_id, query, url FROM batch ORDER BY user_id DESC, query DESC, url DESC LIMIT 1
+"""
+
+async def migrate_search_history():
+    """انتقال جدول قدیمی search_history (متن کامل URL) به search_seen، دسته‌دسته.
+
+    هر دسته با checkpointش (kv_state) در یک تراکنش commit می‌شود؛ قطع شدن = ادامه از همان‌جا.
+    """
+    if not await db_fetchval("SELECT to_regclass('search_history') IS NOT NULL"):
+        return
+    raw = await get_state("search_history_migrate_last")
+    last = tuple(json.loads(raw)) if raw else None
+    logging.info("Migrating search_history -> search_seen (resume from %s) ...", last)
+    moved = 0
+    while True:
+        async with PG_POOL.acquire() as conn:
+            async with conn.transaction():
+                if last is None:
+                    row = await conn.fetchrow(_MIGRATE_BATCH_SQL.format(where=""),
+                                              SEARCH_HISTORY_MIGRATE_BATCH, SEARCH_HISTORY_RETENTION_DAYS)
+                else:
+                    row = await conn.fetchrow(_MIGRATE_BATCH_SQL.format(where="WHERE (user_id, query, url) > ($3, $4, $5)"),
+                                              SEARCH_HISTORY_MIGRATE_BATCH, SEARCH_HISTORY_RETENTION_DAYS, *last)
+                if row is None:
+                    await conn.execute("DROP TABLE search_history")
+                    await conn.execute("DELETE FROM kv_state WHERE key='search_history_migrate_last'")
+                    break
+                last = (row["user_id"], row["query"], row["url"])
                 await conn.execute(
-                    "INSERT INTO search_history(user_id,query,url) VALUES($1,$2,$3) ON CONFLICT DO NOTHING",
-                    user_id, query, u
+                    """INSERT INTO kv_state(key, value) VALUES('search_history_migrate_last', $1)
+                       ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=now()""",
+                    json.dumps(last)
                 )
+        moved += SEARCH_HISTORY_MIGRATE_BATCH
+        if moved % (SEARCH_HISTORY_MIGRATE_BATCH * 20) == 0:
+            logging.info("search_history migration: ~%d rows done", moved)
+        await asyncio.sleep(0)  # بقیهٔ کارهای ربات گرسنه نمانند
+    logging.info("search_history migrated.")
+
+async def _run_search_history_migration():
+    global SEARCH_HISTORY_MIGRATE_TASK
+    try:
+        await migrate_search_history()
+    except Exception as e:
+        logging.warning("search_history migration failed (will resume later): %s", e)
+    finally:
+        SEARCH_HISTORY_MIGRATE_TASK = None
+        BACKGROUND_TASKS.remove(asyncio.current_task())
+
+def start_search_history_migration():
+    """مهاجرت در پس‌زمینه اجرا می‌شود تا startup منتظر جدول چندمیلیونی نماند."""
+    global SEARCH_HISTORY_MIGRATE_TASK
+    if SEARCH_HISTORY_MIGRATE_TASK is None:
+        SEARCH_HISTORY_MIGRATE_TASK = asyncio.create_task(_run_search_history_migration())
+        BACKGROUND_TASKS.append(SEARCH_HISTORY_MIGRATE_TASK)
+
+async def prune_photo_file_ids():
+    await db_execute(
+        "DELETE FROM photo_file_ids WHERE cached_at < now() - make_interval(days => $1)",
+        SEARCH_HISTORY_RETENTION_DAYS
+    )
+
+async def prune_search_cache():
+    # ردیف‌های بعد از TTL موقع خواندن نادیده گرفته می‌شوند؛ اینجا واقعاً پاک می‌شوند
+    await db_execute(
+        "DELETE FROM search_cache WHERE fetched_at < now() - make_interval(secs => $1)",
+        SEARCH_CACHE_TTL
+    )
+
+async def search_history_maintenance():
+    # هر مرحله جدا؛ خطای یکی بقیه را متوقف نکند
+    for step in (ensure_search_partitions, drop_expired_search_partitions, prune_photo_file_ids,
+                 prune_search_cache, prune_update_inbox):
+        try:
+            await step()
+        except Exception as e:
+            logging.warning("maintenance step %s failed: %s", step.__name__, e)
+    start_search_history_migration()
+
+async def search_history_maintenance_loop():
+    while True:
+        await asyncio.sleep(24 * 3600)
+        if not DB_READY:
+            continue
+        try:
+            await search_history_maintenance()
+        except Exception as e:
+            logging.warning("search history maintenance failed: %s", e)
 
 # admin helpers
-async def is_admin(user_id: int) -> bool:
+# لیست ادمین‌ها در حافظه نگه داشته می‌شود؛ /addadmin و /deladmin فوراً آن را به‌روز می‌کنند
+# و با NOTIFY به بقیهٔ پروسه‌ها خبر می‌دهند. refresh دوره‌ای هم پشتیبان است.
+ADMIN_IDS = set()
+ADMINS_CHANNEL = "admins_changed"
+ADMIN_REFRESH_EVERY = int(os.getenv("ADMIN_REFRESH_EVERY", "300"))  # seconds
+LISTEN_CONN = None    # کانکشن جدا برای LISTEN (کانال‌ها در PG_LISTENERS)
+PG_LISTENERS = {}     # channel -> callback(conn, pid, channel, payload)
+BACKGROUND_TASKS = []  # رفرنس تسک‌های پس‌زمینه (تا GC نشوند)
+
+async def load_admins():
+    global ADMIN_IDS
     if not DB_READY:
-        return False
-    r = await db_fetch("SELECT 1 FROM admins WHERE user_id=$1", user_id)
-    return bool(r)
+        return
+    try:
+        rows = await db_fetch("SELECT user_id FROM admins")
+        ADMIN_IDS = {int(r["user_id"]) for r in rows}
+    except Exception as e:
+        logging.warning("load_admins failed: %s", e)
+
+async def notify_admins_changed():
+    await db_execute("SELECT pg_notify($1, '')", ADMINS_CHANNEL)
+
+def _on_admins_notify(conn, pid, channel, payload):
+    asyncio.create_task(load_admins())
+
+PG_LISTENERS[ADMINS_CHANNEL] = _on_admins_notify
+
+async def _ensure_pg_listener():
+    global LISTEN_CONN
+    if LISTEN_CONN is not None and not LISTEN_CONN.is_closed():
+        return
+    try:
+        LISTEN_CONN = await asyncpg.connect(PG_DSN, ssl=PG_SSL)
+        for channel, cb in PG_LISTENERS.items():
+            await LISTEN_CONN.add_listener(channel, cb)
+    except Exception as e:
+        LISTEN_CONN = None
+        logging.warning("LISTEN failed (periodic refresh only): %s", e)
+
+async def admin_sync_loop():
+    while True:
+        if DB_READY:
+            await _ensure_pg_listener()
+            await load_admins()
+        await asyncio.sleep(ADMIN_REFRESH_EVERY)
+
+async def is_admin(user_id: int) -> bool:
+    return int(user_id) in ADMIN_IDS
 
 def admin_only(fn):
     async def wrapper(message: types.Message, *a, **kw):
@@ -336,19 +1359,58 @@ def require_db(fn):
     return wrapper
 
 # ---------- Membership ----------
-async def check_membership(user_id):
-    ok = True
-    for ch in [CHANNEL_1, CHANNEL_2]:
-        try:
-            member = await bot.get_chat_member(chat_id=ch, user_id=user_id)
-            if member.status in ["left", "kicked"]:
-                ok = False
-        except:
-            ok = False
+# کش عضویت: مثبت‌ها طولانی، منفی‌ها کوتاه (تا «✅ عضو شدم» سریع جواب بدهد).
+# آپدیت‌های chat_member (وقتی ربات در کانال ادمین است) کش همان کاربر را باطل می‌کنند.
+MEMBERSHIP_TTL     = int(os.getenv("MEMBERSHIP_TTL", "600"))     # seconds
+MEMBERSHIP_NEG_TTL = int(os.getenv("MEMBERSHIP_NEG_TTL", "15"))  # seconds
+MEMBERSHIP_CACHE_MAX = 50000
+MEMBERSHIP_CACHE = {}  # user_id -> (ok, expires_at)
+
+async def _is_member(ch, user_id) -> bool:
+    try:
+        member = await bot.get_chat_member(chat_id=ch, user_id=user_id)
+        return member.status not in ["left", "kicked"]
+    except:
+        return False
+
+async def check_membership(user_id, force: bool = False):
+    now = time.time()
+    if not force:
+        hit = MEMBERSHIP_CACHE.get(user_id)
+        if hit and hit[1] > now:
+            CACHE_LOOKUPS.inc("membership", "hit")
+            return hit[0]
+        CACHE_LOOKUPS.inc("membership", "miss")
+    # دو کانال هم‌زمان چک می‌شوند
+    results = await asyncio.gather(*(_is_member(ch, user_id) for ch in [CHANNEL_1, CHANNEL_2]))
+    ok = all(results)
+    if len(MEMBERSHIP_CACHE) >= MEMBERSHIP_CACHE_MAX:
+        for k in [k for k, v in MEMBERSHIP_CACHE.items() if v[1] <= now]:
+            del MEMBERSHIP_CACHE[k]
+        if len(MEMBERSHIP_CACHE) >= MEMBERSHIP_CACHE_MAX:
+            MEMBERSHIP_CACHE.clear()
+    MEMBERSHIP_CACHE[user_id] = (ok, now + (MEMBERSHIP_TTL if ok else MEMBERSHIP_NEG_TTL))
     return ok
 
+def _is_membership_channel(chat: types.Chat) -> bool:
+    # CHANNEL_1/2 ممکن است آیدی عددی یا @username باشند
+    for ch in (CHANNEL_1, CHANNEL_2):
+        if not ch:
+            continue
+        if str(chat.id) == str(ch):
+            return True
+        if chat.username and str(ch).lstrip("@").lower() == chat.username.lower():
+            return True
+    return False
+
+@dp.chat_member_handler()
+async def on_channel_member_update(update: types.ChatMemberUpdated):
+    if _is_membership_channel(update.chat):
+        MEMBERSHIP_CACHE.pop(update.new_chat_member.user.id, None)
+
 # ---------- Commands ----------
 @dp.message_handler(CommandStart())
+@timed("start")
 async def start(message: types.Message):
     await upsert_user(message.from_user)  # no-op if DB not ready
     if await check_membership(message.from_user.id):
@@ -372,8 +1434,8 @@ async def help_cmd(message: types.Message):
             "• /send — ارسال همگانی (روی پیام/آلبوم ریپلای کنید)\n"
             "• /addphoto — افزودن عکس به خزانه (روی عکس ریپلای)\n"
             "• /delphoto — پاکسازی عکس‌های حذف‌شدهٔ کانال ۴ از خزانه\n"
-            "• /dbstats — آمار دیتابیس\n"
-            "• /topqueries — برترین جستجوها (۷ روز)\n"
+            "• /dbstats — آمار دیتابیس (/dbstats fast — تقریبی و سریع)\n"
+            "• /topqueries [روز] — برترین جستجوها (پیش‌فرض ۷؛ مثلاً /topqueries 30)\n"
             "• /cancel — خروج از حالت جستجو\n"
             "• /debug — وضعیت ادمین/کانال/DB\n"
             "• /pgdiag — عیب‌یابی اتصال دیتابیس\n\n"
@@ -411,13 +1473,18 @@ async def debug_cmd(message: types.Message):
             await db_fetchval("SELECT 1")
         except Exception:
             db_ok = False
-    await message.reply(
+    text = (
         "🔎 DEBUG\n"
         f"• user_id: {uid}\n"
         f"• admin: {'YES' if admin else 'NO'}\n"
         f"• channels joined: {'YES' if member_ok else 'NO'}\n"
         f"• db: {'OK' if db_ok else 'ERROR'}"
     )
+    if admin:
+        text += f"\n• db pool: {pool_config_text()}"
+        text += f"\n• search cache: {SEARCH_CACHE.stats()}"
+        text += "\n• providers:\n" + provider_stats_text()
+    await message.reply(text)
 
 @dp.message_handler(commands=['pgdiag'])
 async def pgdiag(message: types.Message):
@@ -430,28 +1497,25 @@ async def pgdiag(message: types.Message):
     await message.reply("🩺 PG Diag:\n" + "\n".join(details))
 
 @dp.callback_query_handler(lambda c: c.data == "check_join")
+@timed("check_join")
 async def check_join(call: types.CallbackQuery):
-    if await check_membership(call.from_user.id):
+    if await check_membership(call.from_user.id, force=True):
         await call.message.answer("✅ به به آفرین حالا از دکمه ها استفاده کن عمو", reply_markup=main_kb)
     else:
         await call.message.answer("⛔️ هنوز عضو هر دو کانال نشدی عمو!", reply_markup=join_keyboard())
 
 # آلبوم ادمین برای /send
 @dp.message_handler(content_types=['photo'])
+@timed("cache_admin_album")
 async def cache_admin_album(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
     if not message.media_group_id:
         return
-    gid = str(message.media_group_id)
-    now = time.time()
-    for k in list(ALBUM_CACHE.keys()):
-        if now - ALBUM_CACHE[k]["ts"] > ALBUM_CACHE_TTL:
-            del ALBUM_CACHE[k]
-    file_id = message.photo[-1].file_id
-    caption = message.caption if not ALBUM_CACHE[gid]["media"] else None
-    ALBUM_CACHE[gid]["ts"] = now
-    ALBUM_CACHE[gid]["media"].append(InputMediaPhoto(file_id, caption=caption))
+    await ALBUM_CACHE.append(
+        str(message.media_group_id),
+        {"file_id": message.photo[-1].file_id, "caption": message.caption},
+    )
 
 # --- Admin management ---
 @dp.message_handler(commands=['whoadmins'])
@@ -476,6 +1540,8 @@ async def addadmin(message: types.Message):
     uid = int(parts[1])
     await message.reply("⌛ در حال افزودن ادمین...")
     await db_execute("INSERT INTO admins(user_id) VALUES($1) ON CONFLICT DO NOTHING", uid)
+    ADMIN_IDS.add(uid)
+    await notify_admins_changed()
     await message.reply(f"✅ {uid} اضافه شد.")
 
 @dp.message_handler(commands=['deladmin'])
@@ -489,59 +1555,217 @@ async def deladmin(message: types.Message):
     uid = int(parts[1])
     await message.reply("⌛ در حال حذف ادمین...")
     await db_execute("DELETE FROM admins WHERE user_id=$1", uid)
+    ADMIN_IDS.discard(uid)
+    await notify_admins_changed()
     await message.reply(f"🗑 {uid} حذف شد.")
 
 # --- Broadcast (single/album) ---
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_PROGRESS_EVERY = int(os.getenv("BROADCAST_PROGRESS_EVERY", "30"))  # seconds
+BROADCAST_FLUSH_EVERY = 5  # seconds
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_PAGE = 1000
+# خطاهایی که تکرار فایده ندارد (کاربر ربات را بلاک کرده/حذف شده/...)
+BROADCAST_PERMANENT_ERRORS = (BotBlocked, BotKicked, ChatNotFound, UserDeactivated, CantInitiateConversation)
+RUNNING_BROADCASTS = {}  # job_id -> asyncio.Task
+
+def _album_media(items):
+    return [InputMediaPhoto(it["file_id"], caption=it.get("caption")) for it in items]
+
+async def _broadcast_deliver(job, uid):
+    """ارسال به یک گیرنده با رعایت rate limit؛ خروجی: (status, error)."""
+    media = job["media"]
+    attempts = 0
+    while True:
+        try:
+            if media:
+                await TG_BULK_BUCKET.acquire(len(media))
+                await bot.send_media_group(chat_id=uid, media=_album_media(media))
+            else:
+                await TG_BULK_BUCKET.acquire()
+                await bot.copy_message(chat_id=uid, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+            return "sent", None
+        except RetryAfter as e:
+            # flood-wait سراسری است: کل bucket را متوقف کن و دوباره تلاش کن
+            logging.warning("Broadcast flood-wait %ss", e.timeout)
+            TG_BULK_BUCKET.pause(e.timeout + 1)
+        except BROADCAST_PERMANENT_ERRORS as e:
+            return "failed", str(e)
+        except Exception as e:
+            attempts += 1
+            if attempts >= BROADCAST_MAX_ATTEMPTS:
+                logging.warning("Broadcast to %s failed: %s", uid, e)
+                return "failed", str(e)
+            await asyncio.sleep(2 ** attempts)
+
+async def _broadcast_flush(job_id, results):
+    if not results:
+        return
+    batch = results[:]
+    del results[:]
+    await db_execute(
+        """UPDATE broadcast_recipients r
+           SET status=v.status, error=v.error, attempts=r.attempts+1
+           FROM unnest($2::bigint[], $3::text[], $4::text[]) AS v(user_id, status, error)
+           WHERE r.job_id=$1 AND r.user_id=v.user_id""",
+        job_id, [b[0] for b in batch], [b[1] for b in batch], [b[2] for b in batch]
+    )
+
+async def _broadcast_progress_text(job_id, final=False):
+    rows = await db_fetch(
+        "SELECT status, COUNT(*) c FROM broadcast_recipients WHERE job_id=$1 GROUP BY status", job_id
+    )
+    c = {r["status"]: r["c"] for r in rows}
+    head = f"✅ ارسال همگانی #{job_id} تمام شد" if final else f"📤 ارسال همگانی #{job_id} در جریان است"
+    return (
+        f"{head}\n"
+        f"✅ {c.get('sent', 0)} نفر\n"
+        f"❌ {c.get('failed', 0)} ناموفق\n"
+        f"⏳ {c.get('pending', 0)} باقی‌مانده"
+    )
+
+async def run_broadcast(job_id: int):
+    """اجرای (یا ادامهٔ) یک job: صف گیرنده‌های pending + چند worker + گزارش دوره‌ای."""
+    rows = await db_fetch("SELECT * FROM broadcast_jobs WHERE job_id=$1", job_id)
+    if not rows:
+        return
+    row = rows[0]
+    job = {
+        "from_chat_id": row["from_chat_id"],
+        "message_id": row["message_id"],
+        "media": json.loads(row["media"]) if row["media"] else None,
+    }
+    admin_chat = int(row["admin_chat_id"])
+    queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 4)
+    results = []
+
+    async def worker():
+        while True:
+            uid = await queue.get()
+            if uid is None:
+                return
+            status, err = await _broadcast_deliver(job, uid)
+            results.append((uid, status, err))
+
+    async def reporter():
+        # هر چند ثانیه وضعیت‌ها در DB ثبت می‌شود تا بعد از کرش کمترین ارسال تکراری را داشته باشیم
+        progress_msg = None
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(BROADCAST_FLUSH_EVERY)
+            try:
+                await _broadcast_flush(job_id, results)
+                if time.monotonic() - last_report < BROADCAST_PROGRESS_EVERY:
+                    continue
+                last_report = time.monotonic()
+                text = await _broadcast_progress_text(job_id)
+                if progress_msg is None:
+                    progress_msg = await bot.send_message(admin_chat, text)
+                else:
+                    await bot.edit_message_text(text, chat_id=admin_chat, message_id=progress_msg.message_id)
+            except Exception as e:
+                logging.warning("Broadcast progress #%s failed: %s", job_id, e)
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+    rep = asyncio.create_task(reporter())
+    try:
+        last_uid = -1
+        while True:
+            page = await db_fetch(
+                """SELECT user_id FROM broadcast_recipients
+                   WHERE job_id=$1 AND status='pending' AND user_id > $2
+                   ORDER BY user_id LIMIT $3""",
+                job_id, last_uid, BROADCAST_PAGE
+            )
+            if not page:
+                break
+            for r in page:
+                await queue.put(int(r["user_id"]))
+            last_uid = int(page[-1]["user_id"])
+            await _broadcast_flush(job_id, results)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        rep.cancel()
+        for w in workers:
+            w.cancel()
+        await _broadcast_flush(job_id, results)
+        RUNNING_BROADCASTS.pop(job_id, None)
+
+    await db_execute("UPDATE broadcast_jobs SET status='done', finished_at=now() WHERE job_id=$1", job_id)
+    try:
+        await bot.send_message(admin_chat, await _broadcast_progress_text(job_id, final=True))
+    except Exception as e:
+        logging.warning("Broadcast final report #%s failed: %s", job_id, e)
+
+def start_broadcast(job_id: int):
+    if job_id in RUNNING_BROADCASTS:
+        return
+    task = asyncio.create_task(run_broadcast(job_id))
+    RUNNING_BROADCASTS[job_id] = task
+
+    def _done(t):
+        if not t.cancelled() and t.exception():
+            logging.error("Broadcast #%s crashed: %s", job_id, t.exception())
+    task.add_done_callback(_done)
+
+async def resume_broadcasts():
+    """بعد از ری‌استارت، jobهای نیمه‌کاره از همان‌جا ادامه پیدا می‌کنند."""
+    if not DB_READY:
+        return
+    try:
+        rows = await db_fetch("SELECT job_id FROM broadcast_jobs WHERE status='running' ORDER BY job_id")
+    except Exception as e:
+        logging.warning("resume_broadcasts failed: %s", e)
+        return
+    for r in rows:
+        if int(r["job_id"]) in RUNNING_BROADCASTS:
+            continue
+        logging.info("Resuming broadcast #%s", r["job_id"])
+        start_broadcast(int(r["job_id"]))
+
 @dp.message_handler(commands=["send"])
 @admin_only
 @require_db
+@timed("send_cmd")
 async def send_cmd(message: types.Message):
     if not message.reply_to_message:
         await message.reply("⛔️ باید روی یک پیام (یا یکی از عکس‌های آلبوم) ریپلای کنی.")
         return
-    await message.reply("⌛ دارم ارسال همگانی رو شروع می‌کنم...")
-    rows = await db_fetch("SELECT user_id FROM users")
-    user_ids = [int(r["user_id"]) for r in rows]
-    sent_count = 0
-    error_count = 0
 
     r = message.reply_to_message
+    media = None
     if r.media_group_id:
         gid = str(r.media_group_id)
-        album = ALBUM_CACHE.get(gid)
-        if album and album["media"]:
-            media_group = album["media"][:10]  # Telegram limit per send
-            for uid in user_ids:
-                try:
-                    await bot.send_media_group(chat_id=uid, media=media_group)
-                    sent_count += 1
-                except Exception as e:
-                    logging.warning("Broadcast album to %s failed: %s", uid, e)
-                    error_count += 1
-            if gid in ALBUM_CACHE:
-                del ALBUM_CACHE[gid]
-        else:
-            for uid in user_ids:
-                try:
-                    await bot.copy_message(chat_id=uid, from_chat_id=message.chat.id, message_id=r.message_id)
-                    sent_count += 1
-                except Exception as e:
-                    logging.warning("Broadcast copy to %s failed: %s", uid, e)
-                    error_count += 1
-    else:
-        for uid in user_ids:
-            try:
-                await bot.copy_message(chat_id=uid, from_chat_id=message.chat.id, message_id=r.message_id)
-                sent_count += 1
-            except Exception as e:
-                logging.warning("Broadcast copy to %s failed: %s", uid, e)
-                error_count += 1
-    await message.reply(f"✅ {sent_count} نفر\n❌ {error_count} ناموفق")
+        album = await ALBUM_CACHE.get(gid)
+        if album:
+            media = album[:10]  # Telegram limit per send
+            await ALBUM_CACHE.delete(gid)
+
+    job_id = await db_fetchval(
+        """INSERT INTO broadcast_jobs(admin_chat_id, from_chat_id, message_id, media)
+           VALUES($1,$2,$3,$4) RETURNING job_id""",
+        message.chat.id, message.chat.id, r.message_id, json.dumps(media) if media else None
+    )
+    total = await db_fetchval(
+        """WITH ins AS (
+             INSERT INTO broadcast_recipients(job_id, user_id)
+             SELECT $1, user_id FROM users
+             ON CONFLICT DO NOTHING RETURNING 1
+           ) SELECT COUNT(*) FROM ins""",
+        job_id
+    )
+    await message.reply(f"⌛ ارسال همگانی #{job_id} برای {total or 0} نفر شروع شد؛ گزارش پیشرفت همین‌جا میاد.")
+    if IS_LEADER:
+        start_broadcast(int(job_id))
+    # در غیر این صورت leader در broadcast_watch_loop آن را برمی‌دارد
 
 # --- Add/cleanup photos in Channel 4 ---
 @dp.message_handler(commands=["addphoto"])
 @admin_only
 @require_db
+@timed("addphoto")
 async def addphoto(message: types.Message):
     if not message.reply_to_message or not message.reply_to_message.photo:
         await message.reply("⛔️ باید روی یک عکس ریپلای کنی.")
@@ -553,168 +1777,773 @@ async def addphoto(message: types.Message):
             from_chat_id=message.chat.id,
             message_id=message.reply_to_message.message_id
         )
-        await add_posted_photo(int(sent.message_id))
+        src = message.reply_to_message
+        await add_posted_photo(int(sent.message_id), src.photo[-1].file_id, src.caption, src.caption_entities)
         await message.reply("📥 اضافه شد.")
     except Exception as e:
         await message.reply(f"❌ خطا: {e}")
 
+# بررسی وجود پیام بدون ارسال چیزی: ویرایش کیبورد به «هیچ».
+# «not modified» یعنی پیام هست، «not found» یعنی حذف شده.
+VAULT_SWEEP_EVERY = int(os.getenv("VAULT_SWEEP_EVERY", "0"))  # seconds; 0 = فقط دستی
+VAULT_SWEEP_CONCURRENCY = int(os.getenv("VAULT_SWEEP_CONCURRENCY", "8"))
+VAULT_SWEEP_CHUNK = 200
+VAULT_SWEEP_LOCK = asyncio.Lock()
+VAULT_SWEEP_LOCK_KEY = 0x756E636C6501  # advisory lock (چندپروسه‌ای)
+
+async def _vault_photo_exists(mid: int) -> bool:
+    while True:
+        await TG_BULK_BUCKET.acquire()
+        try:
+            await bot.edit_message_reply_markup(chat_id=CHANNEL_4, message_id=mid)
+            return True
+        except (MessageNotModified, MessageCantBeEdited):
+            return True
+        except (MessageToEditNotFound, MessageIdInvalid):
+            return False
+        except RetryAfter as e:
+            TG_BULK_BUCKET.pause(e.timeout + 1)
+        except Exception as e:
+            # در حالت نامطمئن حذف نمی‌کنیم
+            logging.warning("vault check mid=%s failed: %s", mid, e)
+            return True
+
+async def sweep_vault():
+    """یک دور بررسی خزانه از checkpoint قبلی تا انتها؛ خروجی: (checked, deleted) یا None اگر مشغول باشد."""
+    checked = deleted = 0
+    sem = asyncio.Semaphore(VAULT_SWEEP_CONCURRENCY)
+
+    async def check(mid):
+        async with sem:
+            return mid, await _vault_photo_exists(mid)
+
+    async with VAULT_SWEEP_LOCK, cluster_lock(VAULT_SWEEP_LOCK_KEY) as got:
+        if not got:
+            return None  # پروسهٔ دیگری در حال پاکسازی است
+        last = int(await get_state("vault_sweep_last_mid", 0))
+        while True:
+            rows = await db_fetch(
+                "SELECT message_id FROM posted_photos WHERE message_id > $1 ORDER BY message_id LIMIT $2",
+                last, VAULT_SWEEP_CHUNK
+            )
+            if not rows:
+                await set_state("vault_sweep_last_mid", 0)  # دور کامل شد؛ دفعهٔ بعد از اول
+                break
+            mids = [int(r["message_id"]) for r in rows]
+            results = await asyncio.gather(*(check(m) for m in mids))
+            dead = [m for m, ok in results if not ok]
+            if dead:
+                await db_execute("DELETE FROM posted_photos WHERE message_id = ANY($1::bigint[])", dead)
+            checked += len(mids)
+            deleted += len(dead)
+            last = mids[-1]
+            await set_state("vault_sweep_last_mid", last)
+    return checked, deleted
+
+async def vault_sweep_loop():
+    while True:
+        await asyncio.sleep(VAULT_SWEEP_EVERY)
+        if not DB_READY:
+            continue
+        try:
+            res = await sweep_vault()
+            if res:
+                logging.info("Vault sweep: checked=%s deleted=%s", *res)
+        except Exception as e:
+            logging.warning("Vault sweep failed: %s", e)
+
 @dp.message_handler(commands=["delphoto"])
 @admin_only
 @require_db
+@timed("delphoto")
 async def delphoto(message: types.Message):
+    if VAULT_SWEEP_LOCK.locked():
+        await message.reply("⏳ پاکسازی خزانه همین حالا در جریانه.")
+        return
     await message.reply("⌛ در حال بررسی عکس‌های حذف‌شده...")
-    rows = await db_fetch("SELECT message_id FROM posted_photos")
-    deleted = 0
-    for r in rows:
-        mid = int(r["message_id"])
-        try:
-            await bot.forward_message(chat_id=message.chat.id, from_chat_id=CHANNEL_4, message_id=mid)
-        except Exception:
-            await db_execute("DELETE FROM posted_photos WHERE message_id=$1", mid)
-            deleted += 1
-    await message.reply(f"🧹 حذف‌شده‌ها پاک شد: {deleted}")
+    res = await sweep_vault()
+    if res is None:
+        await message.reply("⏳ پاکسازی خزانه همین حالا در جریانه.")
+        return
+    checked, deleted = res
+    await message.reply(f"🧹 حذف‌شده‌ها پاک شد: {deleted} (از {checked} بررسی‌شده)")
 
 # --- Stats ---
+# همهٔ آمار در یک round trip. شمارش‌های بازه‌ای از ایندکس BRIN روی seen_at استفاده می‌کنند.
+# با «/dbstats fast» جمع کل جداول بزرگ از تخمین planner (pg_class.reltuples) خوانده می‌شود.
+DBSTATS_SQL = """
+SELECT
+  (SELECT COUNT(*) FROM users)         AS users,
+  (SELECT COUNT(*) FROM posted_photos) AS posted,
+  {used}                               AS used,
+  {hist}                               AS hist,
+  (SELECT COUNT(*) FROM search_seen WHERE seen_at >= date_trunc('day', now()))  AS today,
+  (SELECT COUNT(*) FROM search_seen WHERE seen_at >= now() - interval '7 days') AS week
+"""
+_EXACT_COUNT  = "(SELECT COUNT(*) FROM {t})"
+# برای جداول پارتیشن‌شده، تخمین پارتیشن‌ها جمع زده می‌شود
+_APPROX_COUNT = """(SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::bigint FROM pg_class c
+   WHERE c.relkind <> 'p'
+     AND (c.oid = '{t}'::regclass
+          OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = '{t}'::regclass)))"""
+
 @dp.message_handler(commands=['dbstats'])
 @admin_only
 @require_db
+@timed("dbstats")
 async def dbstats(message: types.Message):
+    fast = (message.get_args() or "").strip().lower() == "fast"
     await message.reply("⌛ جمع‌آوری آمار...")
     try:
-        total_users  = await db_fetchval("SELECT COUNT(*) FROM users")
-        total_posted = await db_fetchval("SELECT COUNT(*) FROM posted_photos")
-        total_used   = await db_fetchval("SELECT COUNT(*) FROM used_photos")
-        total_hist   = await db_fetchval("SELECT COUNT(*) FROM search_history")
-        today_hist   = await db_fetchval("SELECT COUNT(*) FROM search_history WHERE seen_at::date = now()::date")
-        week_hist    = await db_fetchval("SELECT COUNT(*) FROM search_history WHERE seen_at >= now() - interval '7 days'")
+        total = _APPROX_COUNT if fast else _EXACT_COUNT
+        rows = await db_fetch(DBSTATS_SQL.format(
+            used=total.format(t="used_photos"),
+            hist=total.format(t="search_seen"),
+        ))
+        r = rows[0]
+        approx = "~" if fast else ""
         await message.reply(
             "📊 آمار دیتابیس:\n"
-            f"👥 Users: {total_users or 0}\n"
-            f"🖼 Posted: {total_posted or 0}\n"
-            f"✅ Used: {total_used or 0}\n"
-            f"🔎 History: {total_hist or 0}\n"
-            f"   • امروز: {today_hist or 0}\n"
-            f"   • ۷ روز اخیر: {week_hist or 0}"
+            f"👥 Users: {r['users'] or 0}\n"
+            f"🖼 Posted: {r['posted'] or 0}\n"
+            f"✅ Used: {approx}{r['used'] or 0}\n"
+            f"🔎 History: {approx}{r['hist'] or 0}\n"
+            f"   • امروز: {r['today'] or 0}\n"
+            f"   • ۷ روز اخیر: {r['week'] or 0}"
         )
     except Exception as e:
         logging.exception("dbstats failed: %s", e)
         await message.reply(f"❌ خطا در آمار: {e}\n"
                             "🔧 /pgdiag را بزن تا وضعیت اتصال مشخص شود.")
 
+TOPQUERIES_MAX_DAYS = 365
+
 @dp.message_handler(commands=['topqueries'])
 @admin_only
 @require_db
+@timed("topqueries")
 async def topqueries(message: types.Message):
+    args = (message.get_args() or "").strip()
+    days = int(args) if args.isdigit() else 7
+    days = max(1, min(days, TOPQUERIES_MAX_DAYS))
     await message.reply("⌛ محاسبهٔ برترین جستجوها...")
     rows = await db_fetch("""
-        SELECT query, COUNT(*) c
-        FROM search_history
-        WHERE seen_at >= now() - interval '7 days'
+        SELECT query, SUM(searches) c
+        FROM search_daily
+        WHERE day > current_date - $1::int
         GROUP BY query
         ORDER BY c DESC
         LIMIT 10
-    """)
+    """, days)
     if not rows:
-        await message.reply("🔎 این هفته جستجویی نداریم.")
+        await message.reply(f"🔎 در {days} روز اخیر جستجویی نداریم.")
         return
     lines = [f"{i+1}. {r['query']} — {r['c']}" for i, r in enumerate(rows)]
-    await message.reply("🏆 Top queries (7d):\n" + "\n".join(lines))
+    await message.reply(f"🏆 Top queries ({days}d):\n" + "\n".join(lines))
 
 # ---------- Artistic/Cinematic Search ----------
-async def search_photos(query, page=1):
-    # استایل ثابت فقط برای کوئری‌های انگلیسی اضافه می‌شود
-    suffix = ", "
-    q = f"{query}{suffix}" if _is_english(query) else query
-
-    urls = []
-    async with aiohttp.ClientSession() as s:
-        # Unsplash
+HTTP_SESSION = None  # یک session مشترک برای کل پروسه (keep-alive + DNS cache)
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", "6"))  # seconds, per provider
+
+def get_http_session() -> aiohttp.ClientSession:
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector)
+    return HTTP_SESSION
+
+async def close_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+async def _get_json(url, params, headers=None):
+    timeout = aiohttp.ClientTimeout(total=PROVIDER_TIMEOUT)
+    async with get_http_session().get(url, params=params, headers=headers, timeout=timeout) as r:
+        r.raise_for_status()  # 401/429 هم خطاست، نه «موفق بدون نتیجه»
+        return await r.json(content_type=None)
+
+async def _search_unsplash(q, page):
+    data = await _get_json(
+        UNSPLASH_API_URL,
+        {
+            "query": q, "page": page, "per_page": 12,
+            "order_by": "relevant", "content_filter": "high",
+            "client_id": UNSPLASH_ACCESS_KEY or "",
+        },
+    )
+    return [d.get("urls", {}).get("regular") for d in data.get("results", [])]
+
+async def _search_pexels(q, page):
+    data = await _get_json(
+        PEXELS_API_URL,
+        {"query": q, "page": page, "per_page": 12, "size": "large"},
+        headers={"Authorization": PEXELS_API_KEY or ""},
+    )
+    return [p["src"].get("large") or p["src"].get("medium") for p in data.get("photos", [])]
+
+async def _search_pixabay(q, page):
+    data = await _get_json(
+        PIXABAY_API_URL,
+        {
+            "key": PIXABAY_API_KEY or "", "q": q, "page": page, "per_page": 12,
+            "image_type": "photo", "safesearch": "true", "order": "popular",
+            "editors_choice": "true",
+        },
+    )
+    return [h.get("webformatURL") for h in data.get("hits", [])]
+
+# ---------- Provider scheduling ----------
+# هر provider آمار تأخیر/خطای خودش را دارد. ترتیب فراخوانی بر اساس امتیاز است و فقط
+# تا وقتی provider بعدی صدا زده می‌شود که SEARCH_WANT عکس «قابل استفاده» (بعد از فیلتر
+# keep، مثلاً دیده‌نشده برای همین کاربر) جمع نشده؛ اگر یکی کند بود بعد از تأخیر hedge
+# نفر بعدی هم شروع می‌شود. چند خطای پشت سر هم = circuit breaker باز.
+# providerِ اندازه‌گیری‌نشده اول امتحان می‌شود و گاهی (PROVIDER_EXPLORE) یکی غیر از
+# بهترین جلو می‌افتد تا آمار همه به‌روز بماند.
+SEARCH_WANT = int(os.getenv("SEARCH_WANT", "10"))
+PROVIDER_EXPLORE = float(os.getenv("PROVIDER_EXPLORE", "0.1"))
+PROVIDER_BREAKER_FAILS = 3
+PROVIDER_BREAKER_COOLDOWN = int(os.getenv("PROVIDER_BREAKER_COOLDOWN", "120"))  # seconds
+PROVIDER_HEDGE_MIN = 0.3   # seconds
+PROVIDER_EWMA = 0.2
+
+class Provider:
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.latency = None     # EWMA (ثانیه) فقط روی موفق‌ها
+        self.error_rate = 0.0   # EWMA
+        self.fails = 0          # خطاهای پشت سر هم
+        self.open_until = 0.0
+        self.calls = 0
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def score(self) -> float:
+        if self.latency is None:
+            return 0.0  # خوش‌بین: هنوز اندازه‌گیری نشده → اول امتحان شود
+        return self.latency * (1 + 4 * self.error_rate)
+
+    def hedge_delay(self) -> float:
+        expected = self.latency if self.latency is not None else PROVIDER_TIMEOUT / 2
+        return min(PROVIDER_TIMEOUT, max(PROVIDER_HEDGE_MIN, expected * 1.5))
+
+    def record(self, ok: bool, elapsed: float):
+        self.calls += 1
+        self.error_rate = (1 - PROVIDER_EWMA) * self.error_rate + PROVIDER_EWMA * (0 if ok else 1)
+        if ok:
+            self.fails = 0
+            self.latency = elapsed if self.latency is None else (
+                (1 - PROVIDER_EWMA) * self.latency + PROVIDER_EWMA * elapsed)
+            return
+        self.fails += 1
+        if self.fails >= PROVIDER_BREAKER_FAILS:
+            # بعد از cooldown یک تلاش آزمایشی؛ اگر باز خطا داد فوراً دوباره باز می‌شود
+            self.open_until = time.monotonic() + PROVIDER_BREAKER_COOLDOWN
+            logging.warning("%s circuit open for %ss", self.name, PROVIDER_BREAKER_COOLDOWN)
+
+    async def call(self, q, page) -> list:
+        t0 = time.monotonic()
         try:
-            u = (
-                "https://api.unsplash.com/search/photos"
-                f"?query={q}&page={page}&per_page=12"
-                "&order_by=relevant&content_filter=high"
-                f"&client_id={UNSPLASH_ACCESS_KEY}"
-            )
-            async with s.get(u) as r:
-                data = await r.json()
-                for d in data.get("results", []):
-                    ureg = d.get("urls", {}).get("regular")
-                    if ureg:
-                        urls.append(ureg)
+            res = await self.fn(q, page)
         except Exception as e:
-            logging.warning("Unsplash fail: %s", e)
+            self.record(False, time.monotonic() - t0)
+            PROVIDER_SECONDS.observe(time.monotonic() - t0, self.name, "error")
+            logging.warning("%s fail: %r", self.name, e)
+            return []
+        self.record(True, time.monotonic() - t0)
+        PROVIDER_SECONDS.observe(time.monotonic() - t0, self.name, "ok")
+        return [u for u in res if u]
+
+    def stats(self) -> str:
+        lat = f"{self.latency * 1000:.0f}ms" if self.latency is not None else "-"
+        state = "OPEN" if not self.available() else "ok"
+        return f"{self.name}: {lat}, err {self.error_rate:.0%}, {state}"
+
+PROVIDERS = [
+    Provider("Unsplash", _search_unsplash),
+    Provider("Pexels", _search_pexels),
+    Provider("Pixabay", _search_pixabay),
+]
+
+def _provider_order() -> list:
+    order = sorted((p for p in PROVIDERS if p.available()), key=Provider.score)
+    if not order:
+        # همه باز هستند: زودتر-بسته‌شونده را امتحان کن
+        return [min(PROVIDERS, key=lambda p: p.open_until)]
+    if len(order) > 1 and random.random() < PROVIDER_EXPLORE:
+        order.insert(0, order.pop(random.randrange(1, len(order))))
+    return order
+
+async def search_photos(query, page=1, want: int = None, keep=None):
+    """URLهای یک صفحه از providerها به ترتیب امتیاز، تا want عدد.
+
+    keep: async (urls) -> زیرمجموعه‌ای که شمرده می‌شود (مثلاً فیلتر «دیده‌شده»)؛
+    نتیجهٔ خام هر provider جدا در SEARCH_CACHE می‌ماند.
+    """
+    want = want or SEARCH_WANT
+    queue = iter(_provider_order())
+    running = {}  # task -> provider
+    urls, seen = [], set()
+
+    async def batch(p):
+        raw = await cached_provider_photos(p, query, page)
+        return await keep(raw) if keep else raw
+
+    def launch():
+        p = next(queue, None)
+        if p is None:
+            return False
+        running[asyncio.create_task(batch(p))] = p
+        return True
+
+    launch()
+    try:
+        while running:
+            hedge = min(p.hedge_delay() for p in running.values())
+            done, _ = await asyncio.wait(running, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                running.pop(t)
+                for u in t.result():
+                    if u not in seen:  # حذف تکراری‌های بین providerها
+                        seen.add(u)
+                        urls.append(u)
+            if len(urls) >= want:
+                break
+            # کم بود یا provider کند است (hedge) → نفر بعدی
+            launch()
+    finally:
+        for t in running:
+            t.cancel()  # fetch مشترک shield شده و کش را پر می‌کند
+    return urls
+
+def provider_stats_text() -> str:
+    return "\n".join(f"   • {p.stats()}" for p in PROVIDERS)
+
+# ---------- Search result cache ----------
+SEARCH_CACHE_TTL  = int(os.getenv("SEARCH_CACHE_TTL", "1800"))  # seconds
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "6000"))  # entries (query, page, provider)
+SEARCH_CACHE_PG   = os.getenv("SEARCH_CACHE_PG", "0") == "1"
+
+class SearchCache:
+    """کش LRU با TTL برای نتایج providerها، با لایهٔ دوم اختیاری در Postgres."""
+
+    def __init__(self, ttl: int, max_size: int, use_pg: bool = False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.use_pg = use_pg
+        self._data = OrderedDict()  # (query, page, provider) -> (expires_at, urls)
+        self.hits = 0
+        self.pg_hits = 0
+        self.misses = 0
+
+    def _put_local(self, key, urls):
+        self._data[key] = (time.time() + self.ttl, urls)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def get(self, key):
+        item = self._data.get(key)
+        if item:
+            if item[0] > time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc("search", "hit")
+                return item[1]
+            del self._data[key]
+        if self.use_pg and DB_READY:
+            try:
+                urls = await db_fetchval(
+                    """SELECT urls FROM search_cache
+                       WHERE query=$1 AND page=$2 AND provider=$3
+                         AND fetched_at > now() - make_interval(secs => $4)""",
+                    key[0], key[1], key[2], self.ttl
+                )
+            except Exception as e:
+                logging.warning("search_cache read failed: %s", e)
+                urls = None
+            if urls:
+                self.pg_hits += 1
+                CACHE_LOOKUPS.inc("search", "pg_hit")
+                self._put_local(key, list(urls))
+                return list(urls)
+        self.misses += 1
+        CACHE_LOOKUPS.inc("search", "miss")
+        return None
+
+    async def put(self, key, urls):
+        if not urls:
+            return  # نتیجهٔ خالی (مثلاً قطعی provider) کش نمی‌شود
+        self._put_local(key, urls)
+        if self.use_pg and DB_READY:
+            try:
+                await db_execute(
+                    """INSERT INTO search_cache(query, page, provider, urls) VALUES($1,$2,$3,$4)
+                       ON CONFLICT (query, page, provider) DO UPDATE SET urls=EXCLUDED.urls, fetched_at=now()""",
+                    key[0], key[1], key[2], urls
+                )
+            except Exception as e:
+                logging.warning("search_cache write failed: %s", e)
+
+    def stats(self) -> str:
+        total = self.hits + self.pg_hits + self.misses
+        rate = (self.hits + self.pg_hits) * 100 / total if total else 0
+        return f"{len(self._data)} keys, hit {self.hits}+{self.pg_hits}(pg) / miss {self.misses} ({rate:.0f}%)"
+
+SEARCH_CACHE = SearchCache(SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE, SEARCH_CACHE_PG)
+
+# درخواست‌های هم‌زمانِ یک (query, page, provider) منتظر همان یک fetch می‌مانند (single-flight)؛
+# فیلتر «دیده‌شده» را هر کاربر جدا روی نتیجه اعمال می‌کند.
+SEARCH_INFLIGHT = {}  # (query, page, provider) -> Task
+
+async def _load_provider_photos(p: Provider, key):
+    urls = await SEARCH_CACHE.get(key)
+    if urls is None:
+        # استایل ثابت فقط برای کوئری‌های انگلیسی اضافه می‌شود
+        suffix = ", "
+        q = f"{key[0]}{suffix}" if _is_english(key[0]) else key[0]
+        urls = await p.call(q, key[1])
+        await SEARCH_CACHE.put(key, urls)
+    return urls
+
+async def cached_provider_photos(p: Provider, query: str, page: int = 1):
+    key = (normalize_query(query), int(page), p.name)
+    task = SEARCH_INFLIGHT.get(key)
+    if task is None:
+        task = SEARCH_INFLIGHT[key] = asyncio.create_task(_load_provider_photos(p, key))
+        task.add_done_callback(lambda _: SEARCH_INFLIGHT.pop(key, None))
+    else:
+        CACHE_LOOKUPS.inc("search", "coalesced")
+    # shield: لغو یک منتظر (مثلاً prefetch یا hedge بازنده) fetch مشترک بقیه را لغو نکند
+    return await asyncio.shield(task)
+
+# ---------- URL -> file_id cache ----------
+# هر عکسی که یک بار در آلبوم جستجو رفت، file_id تلگرامش نگه داشته می‌شود تا دفعهٔ بعد
+# تلگرام دوباره از provider دانلود نکند (سریع‌تر و بدون خطای hotlink).
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "20000"))  # entries در حافظه
+
+class FileIdCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()  # url -> file_id
+
+    def _put_local(self, url, file_id):
+        self._data[url] = file_id
+        self._data.move_to_end(url)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def get_many(self, urls: list) -> dict:
+        found, missing = {}, []
+        for u in urls:
+            fid = self._data.get(u)
+            if fid:
+                self._data.move_to_end(u)
+                found[u] = fid
+            else:
+                missing.append(u)
+        if missing and DB_READY:
+            try:
+                rows = await db_fetch("SELECT url, file_id FROM photo_file_ids WHERE url = ANY($1::text[])", missing)
+            except Exception as e:
+                logging.warning("photo_file_ids read failed: %s", e)
+                rows = []
+            for r in rows:
+                found[r["url"]] = r["file_id"]
+                self._put_local(r["url"], r["file_id"])
+        CACHE_LOOKUPS.inc("file_id", "hit", n=len(found))
+        CACHE_LOOKUPS.inc("file_id", "miss", n=len(urls) - len(found))
+        return found
+
+    async def remember(self, urls: list, messages: list):
+        """file_id بزرگ‌ترین سایز هر پیام آلبوم را برای URL متناظرش ذخیره کن (ترتیب یکی است)."""
+        for u, m in zip(urls, messages):
+            if not m.photo:
+                continue
+            fid = m.photo[-1].file_id
+            if self._data.get(u) != fid:
+                self._put_local(u, fid)
+                await FILE_ID_WB.put((u, fid))
+
+    async def forget(self, urls: list):
+        for u in urls:
+            self._data.pop(u, None)
+        if urls and DB_READY:
+            await db_execute("DELETE FROM photo_file_ids WHERE url = ANY($1::text[])", urls)
+
+async def _flush_file_ids(rows):
+    await db_execute(
+        """INSERT INTO photo_file_ids(url, file_id)
+           SELECT * FROM unnest($1::text[], $2::text[])
+           ON CONFLICT (url) DO UPDATE SET file_id = EXCLUDED.file_id, cached_at = now()""",
+        [r[0] for r in rows], [r[1] for r in rows]
+    )
+
+FILE_ID_CACHE = FileIdCache(FILE_ID_CACHE_SIZE)
+FILE_ID_WB = WriteBehind("photo_file_ids", _flush_file_ids, key_fn=lambda r: r[0])
+
+# ---------- Photo URL validation ----------
+# قبل از ارسال، هر URL با HEAD (یا GET یک‌بایتی اگر HEAD جواب نداد) چک می‌شود: باید
+# تصویر باشد و از سقف ارسال با URL تلگرام (۵MB) بزرگ‌تر نباشد. نتیجه مدتی در حافظه
+# می‌ماند تا کوئری‌های پرتکرار و دستهٔ prefetch‌شده دوباره چک نشوند.
+PHOTO_MAX_BYTES = 5 * 1024 * 1024
+PHOTO_CHECK_TIMEOUT = float(os.getenv("PHOTO_CHECK_TIMEOUT", "3"))  # seconds
+PHOTO_CHECK_CONCURRENCY = int(os.getenv("PHOTO_CHECK_CONCURRENCY", "64"))  # کل پروسه
+PHOTO_CHECK_SEM = asyncio.Semaphore(PHOTO_CHECK_CONCURRENCY)
+PHOTO_CHECKS = OrderedDict()  # url -> (ok, expires_at)
+PHOTO_CHECKS_MAX = 20000
+PHOTO_OK_TTL = 3600
+PHOTO_BAD_TTL = 6 * 3600    # جواب قطعی: 4xx، نوع غیرتصویری، حجم زیاد
+PHOTO_RETRY_TTL = 60        # timeout/خطای اتصال/429/5xx: گذراست، زود دوباره چک شود
+
+def _remember_check(url: str, ok: bool, ttl: float = None):
+    if ttl is None:
+        ttl = PHOTO_OK_TTL if ok else PHOTO_BAD_TTL
+    PHOTO_CHECKS[url] = (ok, time.time() + ttl)
+    PHOTO_CHECKS.move_to_end(url)
+    while len(PHOTO_CHECKS) > PHOTO_CHECKS_MAX:
+        PHOTO_CHECKS.popitem(last=False)
+
+def mark_bad_photo_url(url: str):
+    _remember_check(url, False)
+
+def _known_check(url: str):
+    item = PHOTO_CHECKS.get(url)
+    if item is None:
+        return None
+    if item[1] < time.time():
+        del PHOTO_CHECKS[url]
+        return None
+    return item[0]
+
+def _photo_size(r: aiohttp.ClientResponse):
+    cr = r.headers.get("Content-Range", "")  # bytes 0-0/12345
+    if "/" in cr and cr.rsplit("/", 1)[1].isdigit():
+        return int(cr.rsplit("/", 1)[1])
+    if r.status == 200 and r.content_length is not None:
+        return r.content_length
+    return None
 
-        # Pexels
+def _transient_status(status: int) -> bool:
+    return status == 429 or status >= 500
+
+async def _photo_url_ok(url: str):
+    """True/False برای جواب قطعی؛ None اگر چک به‌خاطر خطای گذرا نتیجه نداد."""
+    timeout = aiohttp.ClientTimeout(total=PHOTO_CHECK_TIMEOUT)
+    session = get_http_session()
+    async with PHOTO_CHECK_SEM:
         try:
-            headers = {"Authorization": PEXELS_API_KEY}
-            u = (
-                "https://api.pexels.com/v1/search"
-                f"?query={q}&page={page}&per_page=12"
-                "&size=large"
-            )
-            async with s.get(u, headers=headers) as r:
-                data = await r.json()
-                for p in data.get("photos", []):
-                    urls.append(p["src"].get("large") or p["src"].get("medium"))
-        except Exception as e:
-            logging.warning("Pexels fail: %s", e)
+            async with session.head(url, allow_redirects=True, timeout=timeout) as r:
+                status, ctype, size = r.status, r.content_type, _photo_size(r)
+            if status >= 400 or size is None:
+                # بعضی CDNها HEAD را نمی‌پذیرند یا طول نمی‌دهند
+                async with session.get(url, headers={"Range": "bytes=0-0"}, allow_redirects=True,
+                                       timeout=timeout) as r:
+                    status, ctype, size = r.status, r.content_type, _photo_size(r)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.info("photo check failed %s: %r", url, e)
+            return None
+    if _transient_status(status):
+        return None
+    return status < 400 and ctype.startswith("image/") and (size is None or size <= PHOTO_MAX_BYTES)
+
+async def pick_valid_urls(urls: list, want: int, known=()) -> list:
+    """تا want عدد URL سالم (به ترتیب)؛ آن‌هایی که file_id دارند چک نمی‌شوند."""
+    async def check(u):
+        if u in known:
+            return True
+        ok = _known_check(u)
+        if ok is None:
+            ok = await _photo_url_ok(u)
+            if ok is None:
+                # نتیجه نامعلوم: فقط برای این آلبوم کنار گذاشته و کوتاه‌مدت یادداشت می‌شود
+                _remember_check(u, False, PHOTO_RETRY_TTL)
+                return False
+            _remember_check(u, ok)
+        return ok
+
+    picked, candidates = [], [u for u in urls if _known_check(u) is not False]
+    while candidates and len(picked) < want:
+        # یک دسته به اندازهٔ کمبود (+چند تا یدک) هم‌زمان چک می‌شود
+        n = (want - len(picked)) + 3
+        batch, candidates = candidates[:n], candidates[n:]
+        picked += [u for u, ok in zip(batch, await asyncio.gather(*(check(u) for u in batch))) if ok]
+    return picked[:want]
+
+# خطاهای BadRequest که به خودِ عکس برمی‌گردند؛ بقیه (مثلاً «not enough rights to send
+# photos» در گروه) مشکل چت است و آلبوم را نصف نمی‌کند و URLی را بد علامت نمی‌زند.
+PHOTO_BAD_ERRORS = ("wrong file identifier", "wrong remote file id", "wrong type of the web page content",
+                    "photo_invalid_dimensions", "image_process_failed", "webpage_media_empty",
+                    "type of file mismatch")
+# تلگرام نتوانست URL را بگیرد: مثل timeout چک خودمان گذراست
+PHOTO_FETCH_ERRORS = ("failed to get http url content", "webpage_curl_failed")
+
+def _photo_error_kind(e: Exception):
+    """'bad' / 'fetch' برای خطای مربوط به عکس؛ None اگر خطا مال چت/کاربر است."""
+    if isinstance(e, ChatNotFound) or not isinstance(e, BadRequest):
+        return None
+    text = str(e).lower()
+    if any(m in text for m in PHOTO_FETCH_ERRORS):
+        return "fetch"
+    if any(m in text for m in PHOTO_BAD_ERRORS):
+        return "bad"
+    return None
 
-        # Pixabay
+async def _send_album_part(message: types.Message, urls: list, file_ids: dict) -> list:
+    """urls را بفرست؛ اگر تلگرام عکسی را رد کرد نصف کن و دوباره. خروجی: [(url, Message)] تحویل‌شده."""
+    while True:
         try:
-            u = (
-                "https://pixabay.com/api/"
-                f"?key={PIXABAY_API_KEY}&q={q}"
-                f"&page={page}&per_page=12"
-                "&image_type=photo&safesearch=true&order=popular&editors_choice=true"
-            )
-            async with s.get(u) as r:
-                data = await r.json()
-                for h in data.get("hits", []):
-                    if h.get("webformatURL"):
-                        urls.append(h["webformatURL"])
+            if len(urls) == 1:
+                u = urls[0]
+                return [(u, await message.answer_photo(file_ids.get(u, u)))]
+            sent = await message.answer_media_group([InputMediaPhoto(file_ids.get(u, u)) for u in urls])
+            return list(zip(urls, sent))
+        except RetryAfter as e:
+            await asyncio.sleep(e.timeout + 1)
+        except BadRequest as e:
+            kind = _photo_error_kind(e)
+            if kind is None:
+                raise
+            if len(urls) > 1:
+                mid = len(urls) // 2
+                logging.info("album of %d rejected (%s); splitting", len(urls), e)
+                return (await _send_album_part(message, urls[:mid], file_ids)
+                        + await _send_album_part(message, urls[mid:], file_ids))
+            u = urls[0]
+            if u in file_ids:
+                # file_id کهنه: یک بار دیگر با خود URL
+                logging.warning("cached file_id for %s failed: %s", u, e)
+                del file_ids[u]
+                await FILE_ID_CACHE.forget([u])
+                continue
+            logging.info("photo rejected by Telegram %s: %s", u, e)
+            if kind == "fetch":
+                _remember_check(u, False, PHOTO_RETRY_TTL)
+            else:
+                mark_bad_photo_url(u)
+            return []
+
+async def send_search_album(message: types.Message, urls: list, file_ids: dict) -> list:
+    """آلبوم را با file_idهای کش‌شده (یا خود URL) بفرست؛ خروجی: URLهایی که واقعاً رسیدند."""
+    file_ids = dict(file_ids)
+    delivered = await _send_album_part(message, urls, file_ids)
+    new = [(u, m) for u, m in delivered if u not in file_ids]
+    await FILE_ID_CACHE.remember([u for u, _ in new], [m for _, m in new])
+    return [u for u, _ in delivered]
+
+# ---------- Search prefetch ----------
+# بعد از هر جواب، دستهٔ تازهٔ بعدی همان (کاربر، کوئری) در پس‌زمینه آماده می‌شود تا
+# «🔁 جستجوی مجدد» یا تکرار همان کوئری بدون انتظار برای providerها جواب بگیرد.
+SEARCH_ALBUM_SIZE = 10   # Telegram media group limit
+PREFETCH_MAX = int(os.getenv("PREFETCH_MAX", "500"))  # تعداد buffer در حافظه
+PREFETCH_TTL = 600       # seconds
+PREFETCH = OrderedDict()  # user_id -> (query, urls, expires_at)
+PREFETCH_TASKS = {}       # user_id -> asyncio.Task
+
+async def find_fresh_urls(uid: int, query: str, exclude=()):
+    """عکس‌های دیده‌نشده برای این کاربر: اول یک صفحهٔ رندوم ۱..۵، اگر کم بود ۶..۱۲.
+
+    providerها تا وقتی صدا زده می‌شوند که SEARCH_ALBUM_SIZE عکس دیده‌نشده جمع شود.
+    """
+    fresh = []
+
+    async def keep(urls):
+        return [u for u in await filter_unseen_urls(uid, query, urls) if u not in exclude and u not in fresh]
+
+    for lo, hi in ((1, 5), (6, 12)):
+        want = SEARCH_ALBUM_SIZE - len(fresh)
+        fresh += await search_photos(query, page=random.randint(lo, hi), want=want, keep=keep)
+        if len(fresh) >= SEARCH_ALBUM_SIZE:
+            break
+    return fresh
+
+def take_prefetched(uid: int, query: str = None):
+    item = PREFETCH.pop(uid, None)
+    if not item or item[2] < time.time() or (query is not None and item[0] != query):
+        CACHE_LOOKUPS.inc("prefetch", "miss")
+        return None
+    CACHE_LOOKUPS.inc("prefetch", "hit")
+    return item
+
+@gauge("unclebot_memory_entries", "In-memory cache/buffer sizes")
+def _memory_gauge():
+    out = [({"store": "search_cache"}, len(SEARCH_CACHE._data)),
+           ({"store": "file_id"}, len(FILE_ID_CACHE._data)),
+           ({"store": "photo_checks"}, len(PHOTO_CHECKS)),
+           ({"store": "membership"}, len(MEMBERSHIP_CACHE)),
+           ({"store": "prefetch"}, len(PREFETCH))]
+    if isinstance(STATE, MemoryStateBackend):
+        out.append(({"store": "state"}, len(STATE._data)))
+    return out
+
+async def _prefetch(uid: int, query: str, exclude):
+    try:
+        fresh = await find_fresh_urls(uid, query, exclude)
+        if not fresh:
+            return
+        try:
+            # نتیجهٔ چک URLها در PHOTO_CHECKS می‌ماند؛ جواب بعدی منتظر HEADها نمی‌شود
+            await pick_valid_urls(fresh, SEARCH_ALBUM_SIZE, known=await FILE_ID_CACHE.get_many(fresh))
         except Exception as e:
-            logging.warning("Pixabay fail: %s", e)
-
-    # حذف تکراری‌های همین نوبت
-    seen, unique = set(), []
-    for u in urls:
-        if u and u not in seen:
-            seen.add(u)
-            unique.append(u)
-    return unique
+            logging.warning("prefetch validation failed uid=%s: %s", uid, e)
+    except Exception as e:
+        logging.warning("prefetch failed uid=%s: %s", uid, e)
+        return
+    finally:
+        # اگر لغو شده‌ایم، schedule_prefetch تسک جدید را جای ما گذاشته؛ آن را پاک نکن
+        if PREFETCH_TASKS.get(uid) is asyncio.current_task():
+            del PREFETCH_TASKS[uid]
+    PREFETCH[uid] = (query, fresh, time.time() + PREFETCH_TTL)
+    PREFETCH.move_to_end(uid)
+    while len(PREFETCH) > PREFETCH_MAX:
+        PREFETCH.popitem(last=False)
+
+def schedule_prefetch(uid: int, query: str, exclude):
+    old = PREFETCH_TASKS.pop(uid, None)
+    if old is not None:
+        old.cancel()
+    PREFETCH_TASKS[uid] = asyncio.create_task(_prefetch(uid, query, set(exclude)))
 
 @require_db
-async def handle_search(message: types.Message):
+@timed("run_search")
+async def run_search(message: types.Message, uid: int, query: str):
     # تمدید تایم‌اوت مود جستجو
-    SEARCH_MODE[message.from_user.id] = time.time()
-
-    uid = int(message.from_user.id)
-    query = (message.text or "").strip().lower()
+    await enter_search_mode(uid)
+    await record_search(query)
 
-    # صفحه رندوم اول
-    page = random.randint(1, 5)
-    batch1 = await search_photos(query, page=page)
-
-    # فیلتر با تاریخچه دیتابیس (عدم تکرار)
-    fresh = [u for u in batch1 if not await has_seen_url(uid, query, u)]
-    if not fresh:
-        page2 = random.randint(6, 12)
-        batch2 = await search_photos(query, page=page2)
-        fresh = [u for u in batch2 if not await has_seen_url(uid, query, u)]
+    pre = take_prefetched(uid, query)
+    fresh = pre[1] if pre else await find_fresh_urls(uid, query)
 
     if not fresh:
         await message.reply("😕 برای این موضوع عکس تازه ندارم. یه چیز دیگه جستجو کن!", reply_markup=retry_keyboard("search"))
         return
 
-    await store_seen_urls(uid, query, fresh)
-
-    media = [InputMediaPhoto(u) for u in fresh[:10]]
-    await message.answer_media_group(media)
+    file_ids = await FILE_ID_CACHE.get_many(fresh)
+    album = await pick_valid_urls(fresh, SEARCH_ALBUM_SIZE, known=file_ids)
+    # فقط همان‌هایی که واقعاً رسیدند «دیده‌شده» ثبت می‌شوند؛ بقیه برای دستهٔ بعد می‌مانند
+    delivered = await send_search_album(message, album, file_ids) if album else []
+    if not delivered:
+        await message.reply("😕 عکسای این موضوع الان در دسترس نیستن. یه کم دیگه یا یه چیز دیگه جستجو کن!",
+                            reply_markup=retry_keyboard("search"))
+        return
+    await store_seen_urls(uid, query, delivered)
     await message.answer("🎬 اگه بازم می‌خوای، دوباره جستجو کن", reply_markup=retry_keyboard("search"))
+    schedule_prefetch(uid, query, exclude=delivered)
+
+async def handle_search(message: types.Message):
+    await run_search(message, int(message.from_user.id), normalize_query(message.text))
 
 # ---------- Callbacks / Random ----------
 @dp.callback_query_handler(lambda c: c.data in ["random", "search"])
+@timed("retry_handler")
 async def retry_handler(call: types.CallbackQuery):
     if not await check_membership(call.from_user.id):
         await call.message.answer("⛔️ اول عضو هر دو کانال شو.", reply_markup=join_keyboard())
@@ -722,10 +2551,21 @@ async def retry_handler(call: types.CallbackQuery):
     if call.data == "random":
         await send_random(call.message, call.from_user.id)
     elif call.data == "search":
-        enter_search_mode(call.from_user.id)
+        uid = int(call.from_user.id)
+        pre = PREFETCH.get(uid)
+        if pre and pre[2] > time.time():
+            # دستهٔ بعدی آخرین کوئری از قبل آماده است
+            await run_search(call.message, uid, pre[0])
+            return
+        await enter_search_mode(uid)
         await call.message.answer("🔎 یه کلمه بفرست تا برات عکساشو بیارم! انگلیسی باشه بهتره")
 
+def _is_dead_photo_error(e: Exception) -> bool:
+    """خطایی که یعنی خودِ عکس (file_id یا پیام خزانه) دیگر قابل ارسال نیست، نه مشکل کاربر/شبکه."""
+    return isinstance(e, BadRequest) and not isinstance(e, ChatNotFound)
+
 @require_db
+@timed("send_random")
 async def send_random(message, user_id):
     picks = await pick_unseen_for_user(int(user_id), limit=3)
     if not picks:
@@ -734,24 +2574,52 @@ async def send_random(message, user_id):
         )
         await message.answer("😅 مونده عکس عمه عکسی رو ببینی دیگه. یه سر به کانال بزن!", reply_markup=kb)
         return
-    sent_any = False
-    for mid in picks:
+    uid = int(user_id)
+    sent, dead = [], []
+    by_file = [r for r in picks if r["file_id"]]
+    if len(by_file) > 1:
+        try:
+            await bot.send_media_group(
+                uid, [InputMediaPhoto(r["file_id"], **_caption_kwargs(r)) for r in by_file]
+            )
+            sent += [int(r["message_id"]) for r in by_file]
+            by_file = []
+        except Exception as e:
+            logging.warning("random media group failed: %s", e)
+            if not _is_dead_photo_error(e):
+                by_file = []  # مشکل از کاربر/شبکه است نه عکس‌ها
+            # وگرنه نمی‌دانیم کدام file_id خراب است؛ پایین تک‌تک امتحان می‌شوند
+    for r in by_file:
+        mid = int(r["message_id"])
         try:
-            await bot.copy_message(chat_id=int(user_id), from_chat_id=CHANNEL_4, message_id=int(mid))
-            await mark_used(int(user_id), int(mid))
-            sent_any = True
+            await bot.send_photo(uid, r["file_id"], **_caption_kwargs(r))
+            sent.append(mid)
         except Exception as e:
             logging.warning("random send failed mid=%s: %s", mid, e)
-            await db_execute("DELETE FROM posted_photos WHERE message_id=$1", int(mid))
-    if sent_any:
+            if _is_dead_photo_error(e):
+                dead.append(mid)
+    # ردیف‌های قدیمی بدون file_id: کپی از خزانه (کپشن خود پست را دارد)
+    for mid in [int(r["message_id"]) for r in picks if not r["file_id"]]:
+        try:
+            await bot.copy_message(chat_id=uid, from_chat_id=CHANNEL_4, message_id=mid)
+            sent.append(mid)
+        except Exception as e:
+            logging.warning("random copy failed mid=%s: %s", mid, e)
+            if _is_dead_photo_error(e):
+                dead.append(mid)
+    for mid in sent:
+        await mark_used(uid, mid)
+    await prune_posted_photos(dead)
+    if sent:
         await message.answer("🎁 اینم از کانال عمو عکسی 😎", reply_markup=retry_keyboard("random"))
     else:
         await message.answer("⛔️ مشکلی پیش اومد، دوباره امتحان کن")
 
 # ---------- Cancel search ----------
 @dp.message_handler(commands=['cancel'])
+@timed("cancel_search")
 async def cancel_search(message: types.Message):
-    exit_search_mode(message.from_user.id)
+    await exit_search_mode(message.from_user.id)
     await message.reply("✅ از حالت جستجو خارج شدی.", reply_markup=main_kb)
 
 # ---------- Unknown command feedback ----------
@@ -764,12 +2632,13 @@ async def unknown_command(message: types.Message):
 
 # ---------- Main text handler (non-command only) ----------
 @dp.message_handler(lambda m: m.text and not m.text.startswith('/'))
+@timed("handle_text")
 async def handle_text(message: types.Message):
     uid = int(message.from_user.id)
     txt = (message.text or "").strip()
 
     if txt == "📸 عکس به سلیقه عمو":
-        exit_search_mode(uid)
+        await exit_search_mode(uid)
         if not await check_membership(uid):
             await message.reply("⛔️ اول باید عضو کانالا باشی!", reply_markup=join_keyboard()); return
         await send_random(message, uid)
@@ -778,21 +2647,21 @@ async def handle_text(message: types.Message):
     elif txt == "🔍 جستجوی دلخواه":
         if not await check_membership(uid):
             await message.reply("⛔️ اول باید عضو کانالا باشی!", reply_markup=join_keyboard()); return
-        enter_search_mode(uid)
+        await enter_search_mode(uid)
         await message.reply("🔎 خب عمو، یه کلمه بفرست برات عکسای خفن بیارم (انگلیسی باشه بهتره)")
         return
 
     elif txt == "ℹ️ درباره من":
-        exit_search_mode(uid)
+        await exit_search_mode(uid)
         await message.reply("👴 من عمو عکسی‌ام! دنیای بینهایتی از عکس دارم؛ همه‌چیز بستگی به سلیقهٔ جستجوی تو داره.")
         return
 
     elif txt == "💬 تماس با مالک عمو عکسی":
-        exit_search_mode(uid)
+        await exit_search_mode(uid)
         await message.reply("📮 برای صحبت با مالک عمو عکسی: @soulsownerbot")
         return
 
-    if in_search_mode(uid):
+    if await in_search_mode(uid):
         if not await check_membership(uid):
             await message.reply("⛔️ اول باید عضو کانالا باشی!", reply_markup=join_keyboard()); return
         await message.reply("⏳ صبر کن... دارم عکسای ناب پیدا می‌کنم...")
@@ -815,6 +2684,19 @@ async def global_errors_handler(update, error):
 # ---------- Startup ----------
 async def on_startup(dp):
     await safe_init_db()
+    await load_admins()
+    configure_state_backend()
+    BACKGROUND_TASKS.append(asyncio.create_task(state_sweep_loop()))
+    BACKGROUND_TASKS.append(asyncio.create_task(admin_sync_loop()))
+    USERS_WB.start()
+    USED_WB.start()
+    SEARCH_DAILY_WB.start()
+    FILE_ID_WB.start()
+    if CLUSTER_MODE != "multi":
+        await leader_startup()
+        start_leader_jobs()
+
+    await start_metrics_server()
 
     await bot.set_my_commands([
         BotCommand("start", "شروع"),
@@ -844,5 +2726,379 @@ async def on_startup(dp):
     except Exception as e:
         logging.exception("Failed to DM initial admin: %s", e)
 
+# chat_member به‌صورت پیش‌فرض ارسال نمی‌شود و باید صریحاً خواسته شود
+ALLOWED_UPDATES = (
+    types.AllowedUpdates.MESSAGE
+    | types.AllowedUpdates.CALLBACK_QUERY
+    | types.AllowedUpdates.CHAT_MEMBER
+)
+
+async def on_shutdown(dp):
+    for t in BACKGROUND_TASKS + list(PREFETCH_TASKS.values()):
+        t.cancel()
+    if LISTEN_CONN is not None and not LISTEN_CONN.is_closed():
+        await LISTEN_CONN.close()
+    await USERS_WB.close()
+    await USED_WB.close()
+    await SEARCH_DAILY_WB.close()
+    await FILE_ID_WB.close()
+    await close_http_session()
+    await stop_metrics_server()
+
+# ---------- Cluster (CLUSTER_MODE=multi) ----------
+# هر پروسه با LISTEN/NOTIFY و SKIP LOCKED آپدیت‌ها را از update_inbox برمی‌دارد؛
+# فقط leader (دارندهٔ advisory lock) polling/webhook setup و کارهای پس‌زمینه را اجرا می‌کند.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LOCK_KEY = 0x756E636C6500
+LEADER_CHECK_EVERY = 10  # seconds
+INBOX_CHANNEL = "update_inbox"
+INBOX_CLAIM_TIMEOUT = 300  # seconds؛ بعد از آن آپدیتِ پروسهٔ مرده دوباره برداشته می‌شود
+INBOX_DONE_KEEP = 2 * 24 * 3600  # seconds؛ بیشتر از ۲۴ ساعتی که تلگرام آپدیت تأییدنشده را نگه می‌دارد
+IS_LEADER = CLUSTER_MODE != "multi"
+LEADER_CONN = None
+LEADER_TASKS = []
+INBOX_WAKE = asyncio.Event()
+
+@contextlib.asynccontextmanager
+async def cluster_lock(key: int):
+    """قفل advisory سراسری برای یک کار (فقط در multi)؛ yield می‌کند که آیا قفل گرفته شد."""
+    if CLUSTER_MODE != "multi":
+        yield True
+        return
+    async with PG_POOL.acquire() as conn:
+        got = await conn.fetchval("SELECT pg_try_advisory_lock($1)", key)
+        try:
+            yield got
+        finally:
+            if got:
+                await conn.execute("SELECT pg_advisory_unlock($1)", key)
+
+async def leader_startup():
+    if not DB_READY:
+        return
+    try:
+        await search_history_maintenance()
+    except Exception as e:
+        logging.warning("search history maintenance failed: %s", e)
+    await resume_broadcasts()
+
+async def broadcast_watch_loop():
+    # jobهایی که روی پروسه‌های دیگر با /send ساخته شده‌اند
+    while True:
+        await asyncio.sleep(LEADER_CHECK_EVERY)
+        await resume_broadcasts()
+
+def start_leader_jobs():
+    LEADER_TASKS.append(asyncio.create_task(search_history_maintenance_loop()))
+    if VAULT_SWEEP_EVERY > 0:
+        LEADER_TASKS.append(asyncio.create_task(vault_sweep_loop()))
+    if CLUSTER_MODE == "multi":
+        LEADER_TASKS.append(asyncio.create_task(broadcast_watch_loop()))
+        if BOT_MODE == "webhook":
+            LEADER_TASKS.append(asyncio.create_task(_set_webhook()))
+        else:
+            LEADER_TASKS.append(asyncio.create_task(poll_into_inbox()))
+
+def _lose_leadership():
+    global IS_LEADER
+    if CLUSTER_MODE != "multi":
+        return
+    IS_LEADER = False
+    for t in LEADER_TASKS + list(RUNNING_BROADCASTS.values()):
+        t.cancel()
+    LEADER_TASKS.clear()
+    RUNNING_BROADCASTS.clear()
+
+async def leader_election_loop():
+    global LEADER_CONN, IS_LEADER
+    while True:
+        try:
+            if LEADER_CONN is None or LEADER_CONN.is_closed():
+                _lose_leadership()
+                LEADER_CONN = await asyncpg.connect(PG_DSN, ssl=PG_SSL)
+            if IS_LEADER:
+                await LEADER_CONN.fetchval("SELECT 1")  # قفل تا وقتی کانکشن زنده است می‌ماند
+            elif await LEADER_CONN.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_KEY):
+                IS_LEADER = True
+                logging.info("Worker %s is now leader.", WORKER_ID)
+                LEADER_TASKS.append(asyncio.create_task(leader_startup()))
+                start_leader_jobs()
+        except Exception as e:
+            logging.warning("leader election: %s", e)
+            _lose_leadership()
+            if LEADER_CONN is not None:
+                LEADER_CONN.terminate()
+            LEADER_CONN = None
+        await asyncio.sleep(LEADER_CHECK_EVERY)
+
+# INSERT و NOTIFY در یک دستور (یک تراکنش): یا هر دو انجام می‌شوند یا هیچ‌کدام.
+# آپدیتی که قبلاً ثبت شده (update_id تکراری) بی‌صدا کنار گذاشته می‌شود.
+INBOX_ENQUEUE_SQL = """
+WITH ins AS (
+  INSERT INTO update_inbox(update_id, user_key, payload)
+  SELECT * FROM unnest($1::bigint[], $2::text[], $3::jsonb[])
+  ON CONFLICT (update_id) DO NOTHING
+  RETURNING 1
+)
+SELECT pg_notify($4, '') FROM (SELECT count(*) AS n FROM ins) c WHERE c.n > 0
+"""
+
+async def enqueue_updates(payloads: list):
+    ids, keys = [], []
+    for p in payloads:
+        uid = _update_user_id(types.Update(**p))
+        ids.append(p.get("update_id"))
+        keys.append(str(uid) if uid is not None else f"u{p.get('update_id')}")
+    await db_execute(INBOX_ENQUEUE_SQL, ids, keys, [json.dumps(p) for p in payloads], INBOX_CHANNEL)
+
+async def poll_into_inbox():
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20, allowed_updates=ALLOWED_UPDATES)
+            if updates:
+                await enqueue_updates([u.to_python() for u in updates])
+                offset = updates[-1].update_id + 1  # فقط بعد از ثبت در inbox تأیید می‌شود
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning("poll_into_inbox: %s", e)
+            await asyncio.sleep(5)
+
+async def _set_webhook(drop_pending: bool = False):
+    await bot.set_webhook(
+        WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=drop_pending,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(100, MAX_INFLIGHT_UPDATES),
+    )
+    logging.info("Webhook set: %s%s", WEBHOOK_HOST, WEBHOOK_PATH)
+
+# قدیمی‌ترین آپدیت هر کاربر که کسی روی آن کار نمی‌کند؛ آپدیت بعدی همان کاربر
+# تا حذف این یکی (پایان پردازش) قابل برداشتن نیست → ترتیب per-user در کل کلاستر.
+INBOX_CLAIM_SQL = """
+UPDATE update_inbox SET claimed_by=$1, claimed_at=now()
+WHERE id IN (
+  SELECT i.id FROM update_inbox i
+  WHERE i.done_at IS NULL
+    AND (i.claimed_by IS NULL OR i.claimed_at < now() - make_interval(secs => $3))
+    AND NOT EXISTS (SELECT 1 FROM update_inbox j
+                    WHERE j.user_key=i.user_key AND j.id < i.id AND j.done_at IS NULL)
+  ORDER BY i.id
+  LIMIT $2
+  FOR UPDATE SKIP LOCKED
+)
+RETURNING id, payload
+"""
+
+def _inbox_done(row_id):
+    async def done():
+        try:
+            await db_execute("UPDATE update_inbox SET done_at=now(), payload='{}' WHERE id=$1", row_id)
+        finally:
+            INBOX_WAKE.set()
+    return done
+
+async def prune_update_inbox():
+    await db_execute(
+        "DELETE FROM update_inbox WHERE done_at < now() - make_interval(secs => $1)",
+        INBOX_DONE_KEEP
+    )
+
+def _on_inbox_notify(conn, pid, channel, payload):
+    INBOX_WAKE.set()
+
+async def inbox_consumer_loop():
+    while True:
+        try:
+            await asyncio.wait_for(INBOX_WAKE.wait(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+        INBOX_WAKE.clear()
+        free = UPDATE_RUNNER.free_slots()
+        if free <= 0 or not DB_READY:
+            continue
+        try:
+            rows = await db_fetch(INBOX_CLAIM_SQL, WORKER_ID, free, INBOX_CLAIM_TIMEOUT)
+        except Exception as e:
+            logging.warning("inbox claim failed: %s", e)
+            continue
+        for r in rows:
+            update = types.Update(**json.loads(r["payload"]))
+            await UPDATE_RUNNER.submit(update, on_done=_inbox_done(r["id"]))
+        if len(rows) == free:
+            INBOX_WAKE.set()  # احتمالاً باز هم هست
+
+async def _cluster_main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    PG_LISTENERS[INBOX_CHANNEL] = _on_inbox_notify
+    UPDATE_RUNNER.start()
+    await on_startup(dp)
+    if not DB_READY:
+        raise SystemExit("CLUSTER_MODE=multi needs a working DATABASE_URL")
+    tasks = [
+        asyncio.create_task(leader_election_loop()),
+        asyncio.create_task(inbox_consumer_loop()),
+    ]
+    site_runner = None
+    if BOT_MODE == "webhook":
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, _webhook_handler)
+        site_runner = web.AppRunner(app)
+        await site_runner.setup()
+        await web.TCPSite(site_runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logging.info("Worker %s started (cluster mode, %s).", WORKER_ID, BOT_MODE)
+
+    await stop.wait()
+    for t in tasks:
+        t.cancel()
+    _lose_leadership()
+    if site_runner is not None:
+        await site_runner.cleanup()
+    await UPDATE_RUNNER.stop()
+    await on_shutdown(dp)
+    if LEADER_CONN is not None:
+        await LEADER_CONN.close()
+    session = await bot.get_session()
+    await session.close()
+
+def run_cluster():
+    if BOT_MODE == "webhook" and not WEBHOOK_HOST:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_HOST")
+    asyncio.run(_cluster_main())
+
+# ---------- Serving (polling / webhook) ----------
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # polling | webhook
+WEBHOOK_HOST   = os.getenv("WEBHOOK_HOST")             # e.g. https://unclebot.example.com
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")           # X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+MAX_INFLIGHT_UPDATES = int(os.getenv("MAX_INFLIGHT_UPDATES", "32"))
+UPDATE_QUEUE_SIZE    = int(os.getenv("UPDATE_QUEUE_SIZE", str(MAX_INFLIGHT_UPDATES * 8)))
+
+def _update_user_id(update: types.Update):
+    for attr in ("message", "edited_message", "callback_query", "chat_member", "my_chat_member", "inline_query"):
+        obj = getattr(update, attr, None)
+        if obj is not None and getattr(obj, "from_user", None) is not None:
+            return obj.from_user.id
+    return None
+
+class UpdateRunner:
+    """اجرای آپدیت‌ها با سقف هم‌زمانی؛ آپدیت‌های یک کاربر به ترتیب و پشت سر هم.
+
+    submit وقتی صف پر است صبر می‌کند (backpressure) به‌جای ساختن تسک‌های بی‌حد.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, workers: int, queue_size: int):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.queue_size = queue_size
+        self._slots = asyncio.Semaphore(queue_size)  # در صف + در حال اجرا
+        self._count = 0
+        self._ready = asyncio.Queue()                # کلید کاربرانی که آپدیت آمادهٔ اجرا دارند
+        self._per_user = {}                          # key -> deque of updates
+        self._tasks = []
+
+    def start(self):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def free_slots(self) -> int:
+        return self.queue_size - self._count
+
+    async def submit(self, update: types.Update, on_done=None):
+        await self._slots.acquire()
+        self._count += 1
+        uid = _update_user_id(update)
+        key = uid if uid is not None else ("update", update.update_id)
+        q = self._per_user.get(key)
+        if q is None:
+            self._per_user[key] = deque([(update, on_done)])
+            self._ready.put_nowait(key)
+        else:
+            q.append((update, on_done))  # کاربر فعلاً در حال اجراست؛ بعد از آن نوبتش می‌رسد
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            q = self._per_user[key]
+            update, on_done = q.popleft()
+            try:
+                await self.dispatcher.process_update(update)
+            except Exception as e:
+                logging.exception("Update %s failed: %s", update.update_id, e)
+            finally:
+                if on_done is not None:
+                    try:
+                        await on_done()
+                    except Exception as e:
+                        logging.warning("Update %s on_done failed: %s", update.update_id, e)
+                self._count -= 1
+                self._slots.release()
+                if q:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._per_user[key]
+
+    async def stop(self, timeout: float = 10):
+        """آپدیت‌های در صف را (تا timeout) تمام کن و workerها را ببند."""
+        deadline = time.monotonic() + timeout
+        while self._per_user and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for t in self._tasks:
+            t.cancel()
+
+UPDATE_RUNNER = UpdateRunner(dp, MAX_INFLIGHT_UPDATES, UPDATE_QUEUE_SIZE)
+
+@gauge("unclebot_pending_updates", "Updates queued or running in the webhook runner")
+def _runner_gauge():
+    return [({}, UPDATE_RUNNER._count)]
+
+async def _webhook_handler(request: web.Request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    data = await request.json()
+    if CLUSTER_MODE == "multi":
+        await enqueue_updates([data])  # هر پروسه‌ای ممکن است برش دارد
+    else:
+        await UPDATE_RUNNER.submit(types.Update(**data))
+    return web.Response()
+
+async def _webhook_startup(app):
+    UPDATE_RUNNER.start()
+    await on_startup(dp)
+    await _set_webhook(drop_pending=True)
+
+async def _webhook_shutdown(app):
+    await UPDATE_RUNNER.stop()
+    await on_shutdown(dp)
+    session = await bot.get_session()
+    await session.close()
+
+def run_webhook():
+    if not WEBHOOK_HOST:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_HOST")
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, _webhook_handler)
+    app.on_startup.append(_webhook_startup)
+    app.on_shutdown.append(_webhook_shutdown)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    if CLUSTER_MODE == "multi":
+        run_cluster()
+    elif BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        executor.start_polling(
+            dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown,
+            allowed_updates=ALLOWED_UPDATES,
+        )